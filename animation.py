@@ -3,77 +3,124 @@ Maxwell Haak
 Final Project
 3/12/20
 Creates an animated map representing the spread of corona virus over time.
+
+Running this file shows the animation, or with --html or --json writes it to
+a standalone file instead.
 """
-from data import dates
-from data import master
+import argparse
+import data
 import numpy as np
 import plotly.graph_objects as go
 
 # Set color scale for animation
 scl_anim = [[0, '#fee0d2'], [1.0, '#de2d26']]
 
-# Create Figure with Corona Virus Map Animation
-frames_list = []
-
-# Adding frames to frameslist
-for date in dates:
-    master_subset = master[master['date_time'] == date]
-    is_washington = master_subset['Province/State'] == 'Washington'
-    master_washington = master_subset[is_washington]
-    frames_list.append(go.Frame(data=[go.Scattergeo(
-                     lon=master_subset['Long'],
-                     lat=master_subset['Lat'],
+hovertemplate = ('<b>%{text}</b><br><br>' +
+                 '<b>Confirmed Cases</b>: %{customdata[0]}<br>' +
+                 '<b>Deaths</b>: %{customdata[1]}<br>' +
+                 '<b>Recovered</b>: %{customdata[2]}')
+
+
+def map_layer(dataset):
+    """
+    Takes a Dataset and returns the level of detail the animation is drawn
+    at, which is the finest one with no more than data.MAX_MARKERS markers
+    over the whole world.
+    """
+    return dataset.spatial.layers[dataset.spatial.choose()]
+
+
+def frame_data(layer, i):
+    """
+    Takes a MapLayer and the position of a date, and returns the parts of
+    the map trace that change from date to date: the counts shown on hover
+    and the marker sizes and colors, as compact typed arrays.
+    """
+    return dict(
+        customdata=layer.store.counts[:, i, :].astype(np.int32),
+        marker=dict(
+            size=(layer.derived['Confirmed_Size'][:, i] *
+                  1.75).astype(np.float32),
+            color=layer.derived['Deaths_Color'][:, i].astype(np.float32)
+        )
+    )
+
+
+def build_frames(dataset):
+    """
+    Takes a Dataset and returns a list with one animation frame per date.
+    Each frame only holds the data that changes between dates, so the
+    locations and coordinates are sent once with the base trace.
+    """
+    layer = map_layer(dataset)
+    frames_list = []
+    for i, date in enumerate(dataset.dates):
+        frames_list.append(go.Frame(
+            name=date,
+            data=[go.Scattergeo(**frame_data(layer, i))],
+            layout=go.Layout(title='Date: ' + date)
+        ))
+    return frames_list
+
+
+def map_trace(dataset, i):
+    """
+    Takes a Dataset and the position of a date, and returns the full map
+    trace for that date, including the locations and coordinates.
+    """
+    layer = map_layer(dataset)
+    values = frame_data(layer, i)
+    values['marker'].update(colorscale=scl_anim,
+                            colorbar_title='Deaths (Natural Log Scale)')
+    return go.Scattergeo(
+                     lon=layer.long,
+                     lat=layer.lat,
+                     text=layer.names,
                      mode='markers',
-                     customdata=np.stack((master_subset['Confirmed'],
-                                          master_subset['Deaths'],
-                                          master_subset['Recovered'],
-                                          master_subset['Province/State']),
-                                axis=-1),
-                     marker=dict(
-                         size=master_subset['Confirmed_Size']*1.75,
-                         color=master_subset['Deaths_Color'],
-                         colorscale=scl_anim
-                     ),
-                     hovertemplate='<b>%{customdata[3]}</b><br><br>' +
-                                   '<b>Confirmed Cases</b>: %{customdata[0]}\
-                                   <br>' +
-                                   '<b>Deaths</b>: %{customdata[1]}<br>' +
-                                   '<b>Recovered</b>: %{customdata[2]}'
-                     )],
-                     layout=go.Layout(
-                         title='Date: ' + str(master_washington['date'])
+                     hovertemplate=hovertemplate,
+                     **values
                      )
-                     ))
 
-# Constructing animation with frameslist
-fig_anim = go.Figure(
-    data=[go.Scattergeo(
-                     lon=master['Long'],
-                     lat=master['Lat'],
-                     mode='markers',
-                     customdata=np.stack((master['Confirmed'],
-                                          master['Deaths'],
-                                          master['Recovered'],
-                                          master['Province/State']), axis=-1),
-                     marker=dict(
-                         size=master['Confirmed_Size']*1.75,
-                         color=master['Deaths_Color'],
-                         colorscale=scl_anim,
-                         colorbar_title='Deaths (Natural Log Scale)'
-                     ),
-                     hovertemplate='<b>%{customdata[3]}</b><br><br>' +
-                                   '<b>Confirmed Cases</b>: %{customdata[0]}\
-                                    <br>' +
-                                   '<b>Deaths</b>: %{customdata[1]}<br>' +
-                                   '<b>Recovered</b>: %{customdata[2]}'
-                     )],
-    layout=go.Layout(
-        updatemenus=[dict(type="buttons",
-                          buttons=[dict(label="Play",
-                                        method="animate",
-                                        args=[None])])]),
-    frames=frames_list
-    )
 
-# Showing animation
-fig_anim.show()
+def build_animation(dataset):
+    """
+    Takes a Dataset and returns the animated map figure, starting on the
+    first date.
+    """
+    return go.Figure(
+        data=[map_trace(dataset, 0)],
+        layout=go.Layout(
+            title='Date: ' + dataset.dates[0],
+            updatemenus=[dict(type="buttons",
+                              buttons=[dict(label="Play",
+                                            method="animate",
+                                            args=[None])])]),
+        frames=build_frames(dataset)
+        )
+
+
+def main():
+    """
+    Builds the animation and shows it, or writes it to the files given on
+    the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--html', help='write a standalone html file')
+    parser.add_argument('--json', help='write the figure as json')
+    args = parser.parse_args()
+
+    # Loading the dataset, from its snapshot when the csv files are
+    # unchanged.
+    fig_anim = build_animation(data.load())
+    if args.html:
+        fig_anim.write_html(args.html, include_plotlyjs=True,
+                            auto_play=False)
+    if args.json:
+        fig_anim.write_json(args.json)
+    if not args.html and not args.json:
+        # Showing animation
+        fig_anim.show()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+Serves the counts behind the dashboard as JSON, so other programs can read
+the same series without going through the page.
+
+Routes, added to the dashboard's Flask server by serve:
+    /api/locations    the key of every region that can be asked for
+    /api/series       the counts of many regions over a range of dates
+
+/api/series takes its query from the url, for example
+    /api/series?location=US&location=Italy&metric=Confirmed&start=2020-03-01
+or as a json object with the same fields (with lists for location and
+metric) in the body of a POST. Locations are region keys such as
+'US / Washington' or plain names such as 'Italy'. By default the response
+holds one record per location and date; with shape=columns it holds the
+list of dates once and a list of counts per location and metric instead.
+
+Responses carry an ETag made from the dataset version and the query, so
+clients can revalidate for free until new data is loaded, and are gzipped
+for clients that accept it.
+"""
+import gzip
+import hashlib
+import json
+import flask
+import pandas as pd
+from cache import LRUCache
+import data
+import metrics
+
+# Seconds clients may reuse a response before revalidating it, the most
+# locations one request may ask for, and the smallest body worth gzipping.
+CACHE_SECONDS = 60
+MAX_LOCATIONS = 1000
+MIN_GZIP_BYTES = 1024
+
+# Encoded response bodies for the most recent queries.
+api_cache = LRUCache(maxsize=256)
+
+
+class QueryError(ValueError):
+    """
+    Raised for a query that cannot be answered, with a message for the
+    client.
+    """
+
+
+def read_query(request):
+    """
+    Takes a Flask request and returns its query as a dictionary of
+    locations, metrics, start, end and shape, from the json body of a POST
+    or from the url otherwise.
+    """
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            raise QueryError('The body must be a json object.')
+        get = body.get
+        locations = body.get('location', [])
+        metric_names = body.get('metric', [])
+    else:
+        get = request.args.get
+        locations = request.args.getlist('location')
+        metric_names = request.args.getlist('metric')
+    return dict(locations=string_list(locations, 'location'),
+                metrics=string_list(metric_names, 'metric'),
+                start=get('start'), end=get('end'),
+                shape=get('shape') or 'records')
+
+
+def string_list(value, field):
+    """
+    Takes the value of a query field and its name, and returns the value as
+    a list of strings. Raises QueryError unless it is a string or a list of
+    strings.
+    """
+    if isinstance(value, str):
+        return [value]
+    if not isinstance(value, list) or \
+            not all(isinstance(item, str) for item in value):
+        raise QueryError(field + ' must be a string or a list of strings.')
+    return value
+
+
+def resolve(dataset, locations):
+    """
+    Takes a Dataset and a list of region keys or names, and returns the
+    position of each in dataset.regions. A plain name stands for the
+    largest region with that name.
+    """
+    hierarchy = dataset.hierarchy
+    positions = []
+    for location in locations:
+        node = hierarchy.position(location)
+        if node < 0:
+            found = hierarchy.find(location)
+            if len(found) == 0:
+                raise QueryError('Unknown location: ' + str(location))
+            node = found[0]
+        positions.append(int(node))
+    return positions
+
+
+def date_range(dataset, start, end):
+    """
+    Takes a Dataset and optional first and last dates in any format pandas
+    understands, and returns the slice of date positions between them.
+    """
+    try:
+        first = 0 if start is None else \
+            dataset.date_times.searchsorted(pd.Timestamp(start))
+        last = len(dataset.dates) if end is None else \
+            dataset.date_times.searchsorted(pd.Timestamp(end), side='right')
+    except (TypeError, ValueError):
+        raise QueryError('Dates must look like 2020-03-22.')
+    return slice(int(first), int(last))
+
+
+def series(dataset, query):
+    """
+    Takes a Dataset and a query from read_query, and returns the counts it
+    asks for as a dictionary ready to be encoded as json.
+    """
+    if not query['locations']:
+        raise QueryError('Ask for at least one location.')
+    if len(query['locations']) > MAX_LOCATIONS:
+        raise QueryError('Ask for at most ' + str(MAX_LOCATIONS) +
+                         ' locations at a time.')
+    if query['shape'] not in ('records', 'columns'):
+        raise QueryError("shape must be 'records' or 'columns'.")
+    store = dataset.regions
+    metric_names = query['metrics'] or store.metrics
+    for metric in metric_names:
+        if metric not in store.metrics:
+            raise QueryError('Unknown metric: ' + str(metric))
+
+    nodes = resolve(dataset, query['locations'])
+    days = date_range(dataset, query['start'], query['end'])
+    dates = list(dataset.date_times[days].strftime('%Y-%m-%d'))
+    counts = {metric: store.counts[nodes, days,
+                                   store.metrics.index(metric)].tolist()
+              for metric in metric_names}
+    result = dict(version=dataset.version)
+    if query['shape'] == 'columns':
+        result.update(locations=query['locations'], dates=dates,
+                      counts=counts)
+    else:
+        result['records'] = [
+            dict(location=location, date=date,
+                 **{metric: counts[metric][i][j] for metric in metric_names})
+            for i, location in enumerate(query['locations'])
+            for j, date in enumerate(dates)]
+    return result
+
+
+def respond(request, version, key, build):
+    """
+    Takes a Flask request, the dataset version, a string identifying the
+    response among those of the same version, and a function of no
+    arguments returning the response as a json-ready value. Returns the
+    Flask response, answering 304 Not Modified when the client already
+    holds it and gzipping it when the client accepts that. The response is
+    only built once per version, key and encoding.
+    """
+    use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    etag = version + '-' + hashlib.sha1(key.encode()).hexdigest()[:16]
+    if use_gzip:
+        etag += '-gzip'
+    if etag in request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        def encode():
+            body = json.dumps(build(), separators=(',', ':')).encode()
+            if use_gzip and len(body) >= MIN_GZIP_BYTES:
+                return gzip.compress(body, compresslevel=6), True
+            return body, False
+
+        body, gzipped = api_cache.get((version, key, use_gzip), encode)
+        response = flask.Response(body, mimetype='application/json')
+        if gzipped:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = ('public, max-age=' +
+                                         str(CACHE_SECONDS))
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def drop_stale_responses(dataset):
+    """
+    Removes the cached responses built for any version other than the given
+    Dataset's, once it has become the current one.
+    """
+    api_cache.prune(lambda key: key[0] == dataset.version)
+
+
+def serve(server, prefix='/api'):
+    """
+    Takes the Flask server of a Dash app and adds the json routes to it
+    under the given prefix.
+    """
+    data.subscribe(drop_stale_responses)
+
+    @server.route(prefix + '/locations')
+    @metrics.callback
+    def api_locations():
+        dataset = data.current()
+        return respond(flask.request, dataset.version, 'locations',
+                       lambda: dict(version=dataset.version,
+                                    locations=list(dataset.hierarchy.keys)))
+
+    @server.route(prefix + '/series', methods=['GET', 'POST'])
+    @metrics.callback
+    def api_series():
+        dataset = data.current()
+        try:
+            query = read_query(flask.request)
+            return respond(flask.request, dataset.version,
+                           json.dumps(query, sort_keys=True),
+                           lambda: series(dataset, query))
+        except QueryError as error:
+            return flask.jsonify(error=str(error)), 400
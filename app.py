@@ -6,237 +6,381 @@ Creates a dash app that lets users interact with the map and line graph
 figures manually.
 """
 # imports for dash app
+import argparse
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 import plotly.graph_objects as go
-import numpy as np
-from data import master
-from data import today
+import pandas as pd
+import api
+from cache import LRUCache
+import data
+import metrics
+from refresh import Refresher
+
+# Making sure a dataset is loaded before the first request. Callbacks look up
+# the current dataset each time they run, so a newly published version is
+# picked up without restarting.
+data.current()
 
 
 # Setting color scale for corona virus map.
 scl = [[0, '#efedf5'], [1.0, '#756bb1']]
 
+# Rendered maps for the most recently requested dates, and rendered line
+# graphs for the most recently requested locations.
+map_cache = LRUCache(maxsize=64)
+graph_cache = LRUCache(maxsize=4096)
+
 # Initializing dash app
 app = dash.Dash(__name__)
 
 server = app.server
 
+# Serving pipeline and callback metrics at /metrics, including the map cache,
+# and the counts as json under /api.
+metrics.serve(server)
+api.serve(server)
+
+
+def cache_metrics():
+    """
+    Copies the map, graph and api cache counters into the metrics registry.
+    """
+    for name, cache in (('map', map_cache), ('graph', graph_cache),
+                        ('api', api.api_cache)):
+        for key, value in cache.info().items():
+            metrics.registry.set('covid_' + name + '_cache_' + key, '',
+                                 value)
+
+
+metrics.registry.add_collector(cache_metrics)
+
+
+def drop_stale_figures(dataset):
+    """
+    Removes the cached maps and line graphs built for any version other
+    than the given Dataset's, once it has become the current one.
+    """
+    for cache in (map_cache, graph_cache):
+        cache.prune(lambda key: key[1] == dataset.version)
+
+
+data.subscribe(drop_stale_figures)
+
 text_style = dict(color='#444', fontFamily='sans-serif', fontWeight=300)
 
 # App Layout
-app.layout = html.Div(
-    children=[
-        html.Div(
-            html.H1('Corona Virus Time Series Data Visualization',
-                    style=text_style)
-        ),
-        html.Div(
-            html.H2('DISCLAIMER', style=text_style)
-        ),
-        html.Div(
-            html.P('''The data for this visualization is from the Center for
-                   Systems Science and Engingeering at Johns Hopkins University
-                   , and has many limitations. Do not use the information presented here as a 
-                   replacement for information from more legitimate sources such as the 
-                   WHO or Johns Hopkins. This visualization is in no way
-                   affiliated with or represents Johns Hopkins University. The data set
-                   used in this project is no longer maintained by Johns Hopkins and is now
-                   deprecated. For current statistics please visit Johns Hopkins' own dashboard.
-                   ''',
-                   style=text_style)
-        ),
-        html.Div([
-            html.P('''This was mainly developed as a class project with the intent
-                    of developing my skills with python, so data may be innacurate.
-                   ''',
-                   style=text_style)
-        ]),
-        html.Div([
+def serve_layout():
+    """
+    Returns the page layout for the current dataset.
+    """
+    dataset = data.current()
+    date_times = dataset.date_times
+    region_keys = ['Total'] + list(dataset.hierarchy.keys)
+    return html.Div(
+        children=[
+            html.Div(
+                html.H1('Corona Virus Time Series Data Visualization',
+                        style=text_style)
+            ),
+            html.Div(
+                html.H2('DISCLAIMER', style=text_style)
+            ),
             html.Div(
-                dcc.DatePickerSingle(
-                    id='date_picker',
-                    min_date_allowed=master['date_time'].min(),
-                    max_date_allowed=master['date_time'].max(),
-                    initial_visible_month=master['date_time'].min(),
-                    date=master['date_time'].min(),
-                    style={'border': '1px solid black'}
-                )
+                html.P('''The data for this visualization is from the Center for
+                       Systems Science and Engingeering at Johns Hopkins University
+                       , and has many limitations. Do not use the information presented here as a 
+                       replacement for information from more legitimate sources such as the 
+                       WHO or Johns Hopkins. This visualization is in no way
+                       affiliated with or represents Johns Hopkins University. The data set
+                       used in this project is no longer maintained by Johns Hopkins and is now
+                       deprecated. For current statistics please visit Johns Hopkins' own dashboard.
+                       ''',
+                       style=text_style)
             ),
+            html.Div([
+                html.P('''This was mainly developed as a class project with the intent
+                        of developing my skills with python, so data may be innacurate.
+                       ''',
+                       style=text_style)
+            ]),
             html.Div([
                 html.Div(
-                    dcc.Graph(id='corona_map'),
-                    style={'width': '74%', 'display': 'inline-block'}
+                    dcc.DatePickerSingle(
+                        id='date_picker',
+                        min_date_allowed=date_times.min(),
+                        max_date_allowed=date_times.max(),
+                        initial_visible_month=date_times.min(),
+                        date=date_times.min(),
+                        style={'border': '1px solid black'}
+                    )
                 ),
                 html.Div([
-                    dcc.Dropdown(
-                            id='loc_drop_down_3',
-                            options=[{'label': i, 'value': i} for i in
-                                     today['Province/State'].unique()],
-                            value='Total'
+                    html.Div(
+                        [dcc.Graph(id='corona_map'),
+                         # The zoom and position of the map, as far as the
+                         # user has changed them.
+                         dcc.Store(id='map_view', data={})],
+                        style={'width': '74%', 'display': 'inline-block'}
                     ),
                     html.Div([
-                        html.Div(
-                            html.H1(id='Confirmed'), style={'height': '25%'}
+                        dcc.Dropdown(
+                                id='loc_drop_down_3',
+                                options=[{'label': i, 'value': i} for i in
+                                         region_keys],
+                                value='Total'
                         ),
-                        html.Div(
-                            html.H1(id='Deaths'), style={'height': '25%'}
-                        ),
-                        html.Div(
-                            html.H1(id='Recovered'), style={'height': '25%'}
-                        )
-                    ])
-                ], style={'width': '25%', 'display': 'inline-block', 'vertical-align': 'top'}
-                )
-            ])
-        ]),
-        html.Div([
-            html.Div([
-                html.Div(
-                    dcc.Dropdown(
-                        id='loc_drop_down_1',
-                        options=[{'label': i, 'value': i} for i in
-                                 master['Province/State'].unique()],
-                        value='Italy'
-                    ),
-                    style={'width': '48%',
-                           'display': 'inline-block'}
-                ),
-                html.Div(
-                    dcc.Dropdown(
-                        id='loc_drop_down_2',
-                        options=[{'label': i, 'value': i} for i in
-                                 master['Province/State'].unique()],
-                        value='Hubei'
-                    ),
-                    style={'width': '48%',
-                           'align': 'right',
-                           'display': 'inline-block'}
-                )
+                        html.Div([
+                            html.Div(
+                                html.H1(id='Confirmed'), style={'height': '25%'}
+                            ),
+                            html.Div(
+                                html.H1(id='Deaths'), style={'height': '25%'}
+                            ),
+                            html.Div(
+                                html.H1(id='Recovered'), style={'height': '25%'}
+                            )
+                        ])
+                    ], style={'width': '25%', 'display': 'inline-block', 'vertical-align': 'top'}
+                    )
+                ])
             ]),
             html.Div([
-                html.Div(
-                    dcc.Graph(
-                        id='loc_graph_1'
+                html.Div([
+                    html.Div(
+                        dcc.Dropdown(
+                            id='loc_drop_down_1',
+                            options=[{'label': i, 'value': i} for i in
+                                     dataset.master_index],
+                            value='Italy'
+                        ),
+                        style={'width': '48%',
+                               'display': 'inline-block'}
                     ),
-                    style={'width': '48%',
-                           'display': 'inline-block'}
-                ),
-                html.Div(
-                    dcc.Graph(
-                        id='loc_graph_2'
+                    html.Div(
+                        dcc.Dropdown(
+                            id='loc_drop_down_2',
+                            options=[{'label': i, 'value': i} for i in
+                                     dataset.master_index],
+                            value='Hubei'
+                        ),
+                        style={'width': '48%',
+                               'align': 'right',
+                               'display': 'inline-block'}
+                    )
+                ]),
+                html.Div([
+                    html.Div(
+                        dcc.Graph(
+                            id='loc_graph_1'
+                        ),
+                        style={'width': '48%',
+                               'display': 'inline-block'}
                     ),
-                    style={'width': '48%',
-                           'align': 'right',
-                           'display': 'inline-block'}
-                )
+                    html.Div(
+                        dcc.Graph(
+                            id='loc_graph_2'
+                        ),
+                        style={'width': '48%',
+                               'align': 'right',
+                               'display': 'inline-block'}
+                    )
+                ])
             ])
-        ])
-    ]
-)
+        ]
+    )
+
+
+app.layout = serve_layout
 
 
 @app.callback(
     [Output(component_id='Confirmed', component_property='children'),
      Output(component_id='Deaths', component_property='children'),
      Output(component_id='Recovered', component_property='children')],
-    [Input(component_id='loc_drop_down_3', component_property='value')]
+    [Input(component_id='loc_drop_down_3', component_property='value'),
+     Input(component_id='date_picker', component_property='date')]
 )
-def update_confirmed_text(location):
-    today_subset = today[today['Province/State'] == location]
-    confirmed = int(today_subset['Confirmed'])
-    deaths = int(today_subset['Deaths'])
-    recovered = int(today_subset['Recovered'])
-    confirmed_str = 'Confirmed: ' + str(confirmed)
-    deaths_str = 'Deaths: ' + str(deaths)
-    recovered_str = 'Recovered: ' + str(recovered)
+@metrics.callback
+def update_confirmed_text(location, date):
+    """
+    Return the counts for specified region on the date picked, read from
+    the precomputed region totals.
+    """
+    dataset = data.current()
+    values = dataset.region(location, dataset.day(date))
+    confirmed_str = 'Confirmed: ' + str(values['Confirmed'])
+    deaths_str = 'Deaths: ' + str(values['Deaths'])
+    recovered_str = 'Recovered: ' + str(values['Recovered'])
     return confirmed_str, deaths_str, recovered_str
 
 
-@app.callback(
-    Output(component_id='loc_graph_1', component_property='figure'),
-    [Input(component_id='loc_drop_down_1', component_property='value')]
-)
-def update_loc_graph_1(location):
+def location_rows(dataset, location):
     """
-    Return line graph for specified location on app callback.
+    Returns the rows of master for the given location, looked up through the
+    precomputed location index instead of scanning every row.
     """
-    master_subset = master[master['Province/State'] == location]
-    fig = go.Figure(
-        data=go.Scatter(
-            x=master_subset['date_time'],
-            y=master_subset['Confirmed'],
-            name='Confirmed Cases'
-        )
-    )
-    fig.add_scatter(x=master_subset['date_time'], y=master_subset['Deaths'],
-                    name='Deaths')
-    fig.add_scatter(x=master_subset['date_time'], y=master_subset['Recovered'],
-                    name='Recovered')
-    fig.update_layout(
-        title=location,
-        xaxis_title="Date",
-        yaxis_title="Number of People"
+    rows = dataset.master_index.get(location, slice(0, 0))
+    return dataset.master.iloc[rows]
+
+
+def location_figure(dataset, location):
+    """
+    Returns the line graph of confirmed cases, deaths and recoveries over
+    time for a location of a Dataset, as a dictionary ready to be sent to
+    the browser.
+    """
+    master_subset = location_rows(dataset, location)
+    x = dataset.date_times[master_subset['day']].strftime('%Y-%m-%d')
+    traces = [('Confirmed', 'Confirmed Cases'), ('Deaths', 'Deaths'),
+              ('Recovered', 'Recovered')]
+    return dict(
+        data=[dict(type='scatter', x=list(x), y=master_subset[col].tolist(),
+                   name=name) for col, name in traces],
+        layout=dict(title=dict(text=location),
+                    xaxis=dict(title=dict(text='Date')),
+                    yaxis=dict(title=dict(text='Number of People')))
     )
-    return fig
+
+
+def location_graph_callback(graph_id, drop_down_id):
+    """
+    Registers the callback drawing the line graph with the given id for the
+    location picked in the given dropdown, and returns it. Graphs are built
+    once per location and dataset version and then served from graph_cache,
+    which all the line graphs share.
+    """
+    def update_loc_graph(location):
+        """
+        Return line graph for specified location on app callback.
+        """
+        dataset = data.current()
+        return graph_cache.get((location, dataset.version),
+                               lambda: location_figure(dataset, location))
+
+    update_loc_graph.__name__ = 'update_' + graph_id
+    return app.callback(
+        Output(component_id=graph_id, component_property='figure'),
+        [Input(component_id=drop_down_id, component_property='value')]
+    )(metrics.callback(update_loc_graph))
+
+
+update_loc_graph_1 = location_graph_callback('loc_graph_1', 'loc_drop_down_1')
+update_loc_graph_2 = location_graph_callback('loc_graph_2', 'loc_drop_down_2')
 
 
 @app.callback(
-    Output(component_id='loc_graph_2', component_property='figure'),
-    [Input(component_id='loc_drop_down_2', component_property='value')]
+    Output(component_id='map_view', component_property='data'),
+    [Input(component_id='corona_map', component_property='relayoutData')],
+    [State(component_id='map_view', component_property='data')]
 )
-def update_loc_graph_2(value):
+def update_map_view(change, view):
     """
-    Return line graph for specified location on app callback.
+    Keeps the view of the map up to date as the user zooms and pans it.
+    Plotly only reports the parts of the view that changed, so they are
+    merged into the view saved so far.
     """
-    master_subset = master[master['Province/State'] == value]
-    fig = go.Figure(
-        data=[go.Scatter(
-            x=master_subset['date_time'],
-            y=master_subset['Confirmed'],
-            name='Confirmed Cases'
-        )]
-    )
-    fig.add_scatter(x=master_subset['date_time'], y=master_subset['Deaths'],
-                    name='Deaths')
-    fig.add_scatter(x=master_subset['date_time'], y=master_subset['Recovered'],
-                    name='Recovered')
-    fig.update_layout(
-        title=value,
-        xaxis_title="Date",
-        yaxis_title="Number of People"
-    )
-    return fig
+    view = merge_view(view, change)
+    if view is None:
+        raise PreventUpdate
+    return view
+
+
+def merge_view(view, change):
+    """
+    Takes the map view saved so far and the relayoutData of the map, and
+    returns the view with the changed geo settings applied, or None if
+    nothing about the view changed.
+    """
+    merged = dict(view or {})
+    for key, value in flatten(change or {}).items():
+        if key.startswith('geo.'):
+            merged[key] = value
+    return None if merged == (view or {}) else merged
+
+
+def flatten(settings, prefix=''):
+    """
+    Takes a dictionary of plotly layout settings, which may be nested, and
+    returns it with dotted keys such as 'geo.center.lat'.
+    """
+    flat = {}
+    for key, value in settings.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
 
 
 @app.callback(
     Output(component_id='corona_map', component_property='figure'),
-    [Input(component_id='date_picker', component_property='date')]
+    [Input(component_id='date_picker', component_property='date'),
+     Input(component_id='map_view', component_property='data')]
 )
-def update_corona_map(date):
+@metrics.callback
+def update_corona_map(date, view=None):
+    """
+    Return geo scatterplot map for specified date on app callback, at the
+    finest level of detail that keeps the markers in view under the limit.
+    """
+    dataset = data.current()
+    date = pd.Timestamp(date).normalize()
+    bounds = map_bounds(view)
+    level = dataset.spatial.choose(bounds)
+    return map_cache.get((date, dataset.version, level, bounds),
+                         lambda: corona_map(dataset, date, level, bounds))
+
+
+def map_bounds(view):
+    """
+    Takes the view of the map saved by update_map_view, and returns the
+    (south, north, west, east) bounds in degrees of the part in view,
+    rounded so nearby views share a cache entry, or None when the whole
+    world is in view. The west and east bounds may run past 180 degrees
+    when the view crosses the antimeridian.
+    """
+    view = view or {}
+    scale = view.get('geo.projection.scale') or 1
+    if scale <= 1:
+        return None
+    lat = view.get('geo.center.lat') or 0
+    lon = view.get('geo.center.lon')
+    if lon is None:
+        lon = view.get('geo.projection.rotation.lon') or 0
+    lon = (lon + 180) % 360 - 180
+    return tuple(round(value, 1) for value in
+                 (lat - 90 / scale, lat + 90 / scale,
+                  lon - 180 / scale, lon + 180 / scale))
+
+
+def corona_map(dataset, date, level=-1, bounds=None):
     """
-    Return geo scatterplot map for specified date on app callback.
+    Returns the geo scatterplot map of a Dataset for the given date as a
+    dictionary ready to be sent to the browser, drawing the markers of the
+    given level of detail that fall within the bounds.
     """
-    master_subset = master[master['date_time'] == date]
+    layer = dataset.spatial.layers[level]
+    i = dataset.day(date)
+    markers = layer.visible(bounds)
     fig = go.Figure(
         go.Scattergeo(
-                     lon=master_subset['Long'],
-                     lat=master_subset['Lat'],
+                     lon=layer.long[markers],
+                     lat=layer.lat[markers],
                      mode='markers',
-                     customdata=np.stack((master_subset['Confirmed'],
-                                          master_subset['Deaths'],
-                                          master_subset['Recovered'],
-                                          master_subset['Province/State']),
-                                         axis=-1),
+                     text=layer.names[markers],
+                     customdata=layer.store.counts[markers, i, :],
                      marker=dict(
-                         size=master_subset['Confirmed_Size']*1.75,
-                         color=master_subset['Deaths_Color'],
+                         size=layer.derived['Confirmed_Size'][markers, i] *
+                         1.75,
+                         color=layer.derived['Deaths_Color'][markers, i],
                          colorscale=scl,
                          colorbar_title='Deaths (Natural Log Scale)'
                      ),
-                     hovertemplate='<b>%{customdata[3]}</b><br><br>' +
+                     hovertemplate='<b>%{text}</b><br><br>' +
                                    '<b>Confirmed Cases</b>: %{customdata[0]}\
                                     <br>' +
                                    '<b>Deaths</b>: %{customdata[1]}<br>' +
@@ -250,8 +394,10 @@ def update_corona_map(date):
         showocean=True,
         oceancolor='#a8d7ff'
     )
-    fig.update_layout(height=300, margin={"r": 0, "t": 0, "l": 0, "b": 0})
-    return fig
+    # Keeping the user's zoom when the markers are redrawn for it.
+    fig.update_layout(height=300, margin={"r": 0, "t": 0, "l": 0, "b": 0},
+                      uirevision='map')
+    return fig.to_dict()
 
 
 # CSS stylesheet
@@ -260,4 +406,16 @@ app.css.append_css({
 })
 
 
-app.server.run()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--refresh', type=float, metavar='SECONDS',
+                        help='download new data on this interval')
+    parser.add_argument('--daily', metavar='FOLDER',
+                        help='read this folder of daily report files '
+                             'instead of the time series files')
+    args = parser.parse_args()
+    if args.daily:
+        data.load_daily(args.daily)
+    if args.refresh:
+        Refresher(args.refresh, folder=args.daily).start()
+    app.server.run()
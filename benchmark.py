@@ -0,0 +1,315 @@
+"""
+Benchmarks each stage of the data pipeline, the dashboard callbacks and the
+animation frame build on synthetic csv files in the Johns Hopkins wide
+format, and writes the timings and memory use to a json file so runs can be
+compared with each other.
+
+Example:
+    python benchmark.py --locations 20000 --dates 1000 --out bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import data
+
+# Two letter codes used to name synthetic US counties.
+STATE_CODES = list(data.STATE_CODES)[:50]
+
+
+def date_names(n_dates):
+    """
+    Takes a number of dates and returns that many date column names in the
+    m/d/yy format used by the csv files, starting on 1/22/20.
+    """
+    days = pd.date_range('2020-01-22', periods=n_dates)
+    return [str(d.month) + '/' + str(d.day) + '/' + d.strftime('%y')
+            for d in days]
+
+
+def synthetic_locations(n_locations, rng):
+    """
+    Takes a number of locations and a random generator, and returns a
+    location dataframe shaped like the csv files: mostly countries, some
+    split into provinces, and US states along with US counties.
+    """
+    n_us = min(n_locations // 10, 2000)
+    n_states = min(n_us, 50)
+    states = list(data.US_STATES[:n_states])
+    counties = ['County ' + str(i) + ', ' + STATE_CODES[i % 50]
+                for i in range(n_us - n_states)]
+    n_other = n_locations - n_us
+    n_countries = max(1, n_other // 4)
+    country = np.arange(n_other) % n_countries
+    province = np.where(country == np.arange(n_other), None,
+                        np.char.add('Province ', np.arange(n_other)
+                                    .astype(str)).astype(object))
+    locations = pd.DataFrame({
+        'Province/State': list(province) + states + counties,
+        'Country/Region': (['Country ' + str(c) for c in country] +
+                           ['US'] * n_us),
+    })
+    locations['Lat'] = rng.uniform(-60, 70, n_locations).round(4)
+    locations['Long'] = rng.uniform(-180, 180, n_locations).round(4)
+    return locations
+
+
+def synthetic_counts(n_locations, n_dates, rng):
+    """
+    Takes the numbers of locations and dates and a random generator, and
+    returns cumulative (locations, dates) arrays of confirmed cases, deaths
+    and recoveries, where each location's outbreak starts on a random date
+    and grows at a random rate.
+    """
+    start = rng.integers(0, n_dates, n_locations)[:, np.newaxis]
+    rate = rng.uniform(0.02, 0.2, n_locations)[:, np.newaxis]
+    days = np.arange(n_dates) - start
+    expected = np.where(days >= 0, np.minimum(np.exp(rate * days), 1e4), 0)
+    confirmed = np.cumsum(rng.poisson(expected), axis=1)
+    deaths = np.cumsum(rng.binomial(np.diff(confirmed, prepend=0), 0.03),
+                       axis=1)
+    recovered = np.cumsum(rng.binomial(np.diff(confirmed - deaths,
+                                               prepend=0), 0.6), axis=1)
+    return confirmed, deaths, recovered
+
+
+def make_synthetic(out_dir, n_locations, n_dates, seed=0):
+    """
+    Takes an output folder, the numbers of locations and dates, and a random
+    seed. Writes synthetic confirmed, deaths and recovered csv files in the
+    Johns Hopkins wide format to the folder and returns the list of
+    (metric, url, file name) sources for them.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    locations = synthetic_locations(n_locations, rng)
+    dates = date_names(n_dates)
+    sources = []
+    for metric, counts in zip(data.METRICS,
+                              synthetic_counts(n_locations, n_dates, rng)):
+        frame = pd.concat([locations,
+                           pd.DataFrame(counts, columns=dates)], axis=1)
+        file_name = os.path.join(out_dir, 'covid19_' + metric.lower() +
+                                 '.csv')
+        frame.to_csv(file_name, index=False)
+        sources.append((metric, None, file_name))
+    return sources
+
+
+def make_daily(out_dir, sources):
+    """
+    Takes an output folder and the sources returned by make_synthetic, and
+    writes the same counts to the folder as one daily report file per date.
+    Like the real reports, files before 3/1/20 have no coordinates, files
+    from 3/1/20 name them Latitude and Longitude, and files from 3/22/20
+    use the newer column names with US counties split into Admin2 and
+    their state. Returns the list of file names written.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    frames = {metric: pd.read_csv(file_name)
+              for metric, _, file_name in sources}
+    locations = frames['Confirmed'][data.ID_COLS]
+    province = locations['Province/State'].fillna('')
+    parts = province.str.rsplit(', ', n=1)
+    is_county = (locations['Country/Region'] == 'US') & \
+        province.str.contains(', ', regex=False)
+    file_names = []
+    for date in data.date_columns(frames['Confirmed']):
+        day = pd.to_datetime(date, format='%m/%d/%y')
+        report = pd.DataFrame({metric: frames[metric][date]
+                               for metric in data.METRICS})
+        if day < pd.Timestamp('2020-03-22'):
+            report.insert(0, 'Province/State', locations['Province/State'])
+            report.insert(1, 'Country/Region', locations['Country/Region'])
+            report.insert(2, 'Last Update', day.isoformat())
+            if day >= pd.Timestamp('2020-03-01'):
+                report['Latitude'] = locations['Lat']
+                report['Longitude'] = locations['Long']
+        else:
+            report.insert(0, 'Admin2', parts.str[0].where(is_county))
+            report.insert(1, 'Province_State', province.where(
+                ~is_county, parts.str[-1].map(data.STATE_CODES)))
+            report.insert(2, 'Country_Region', locations['Country/Region'])
+            report.insert(3, 'Last_Update', day.isoformat())
+            report.insert(4, 'Lat', locations['Lat'])
+            report.insert(5, 'Long_', locations['Long'])
+        file_name = os.path.join(out_dir, day.strftime('%m-%d-%Y') + '.csv')
+        report.to_csv(file_name, index=False)
+        file_names.append(file_name)
+    return file_names
+
+
+def measure(function, repeat):
+    """
+    Takes a function of no arguments and a number of repeats. Calls the
+    function once while tracing memory and then repeat more times, and
+    returns its result along with a dictionary of the fastest time in
+    seconds and the peak memory allocated in megabytes.
+    """
+    tracemalloc.start()
+    result = function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return result, dict(seconds=min(times), peak_mb=peak / 2 ** 20)
+
+
+def legacy_merge(frames):
+    """
+    Takes a dictionary of melted dataframes and joins them by row position,
+    the way master used to be built, for comparison with build_store.
+    """
+    merged = frames['Confirmed']
+    for df in list(frames.values())[1:]:
+        cols_to_use = df.columns.difference(merged.columns)
+        merged = pd.merge(merged, df[cols_to_use], left_index=True,
+                          right_index=True, how='outer')
+    return merged
+
+
+def pipeline_stages(sources, legacy):
+    """
+    Takes the synthetic sources and whether to include the old county
+    removal, melt and merge stages, and returns a list of (name, function)
+    stages. Each function takes a dictionary of earlier results and returns
+    its own.
+    """
+    stages = [
+        ('read', lambda r: {metric: data.pd_0(file_name)
+                            for metric, _, file_name in sources}),
+    ]
+    if legacy:
+        stages += [
+            ('remove_us_counties',
+             lambda r: {metric: data.remove_us_counties(df)
+                        for metric, df in r['read'].items()}),
+            ('melt', lambda r: {metric: data.melter(df, metric, data.ID_COLS)
+                                for metric, df in
+                                r['remove_us_counties'].items()}),
+            ('merge', lambda r: legacy_merge(r['melt'])),
+        ]
+    stages += [
+        ('build_store', lambda r: data.build_store(r['read'])),
+        ('rollup', lambda r: r['build_store'].rollup('Country/Region')),
+        ('hierarchy',
+         lambda r: data.Hierarchy(r['build_store'].locations)),
+        ('regions', lambda r: r['hierarchy'].rollup(r['build_store'])),
+        ('summaries', lambda r: data.Dataset(r['build_store'],
+                                             r['rollup'], 'bench')),
+        ('derived', lambda r: data.compute_derived(r['build_store'])),
+        ('master', lambda r: data.master_frame(r['build_store'],
+                                               r['derived'])),
+    ]
+    return stages
+
+
+def callback_stages():
+    """
+    Returns a list of (name, function) stages timing the dashboard callbacks
+    and the animation on the current dataset. The map and line graph are
+    timed both when they have to be built and when they come from their
+    caches.
+    """
+    import animation
+    import app
+    dataset = data.current()
+    location = next(iter(dataset.master_index))
+    date = pd.Timestamp(dataset.dates[-1])
+
+    def map_miss(r):
+        app.map_cache.clear()
+        return app.update_corona_map(date)
+
+    def graph_miss(r):
+        app.graph_cache.clear()
+        return app.update_loc_graph_1(location)
+
+    return [
+        ('update_loc_graph_miss', graph_miss),
+        ('update_loc_graph_hit', lambda r: app.update_loc_graph_1(location)),
+        ('update_confirmed_text',
+         lambda r: app.update_confirmed_text(location, date)),
+        ('update_corona_map_miss', map_miss),
+        ('update_corona_map_hit', lambda r: app.update_corona_map(date)),
+        ('animation_frames', lambda r: animation.build_frames(dataset)),
+    ]
+
+
+def run(n_locations, n_dates, repeat=3, legacy=True, seed=0):
+    """
+    Takes the numbers of synthetic locations and dates, the number of timed
+    repeats, whether to include the old county removal, melt and merge
+    stages, and a random seed. Runs every stage and returns the results as
+    a dictionary.
+    """
+    results = dict(locations=n_locations, dates=n_dates, repeat=repeat,
+                   python=platform.python_version(),
+                   numpy=np.__version__, pandas=pd.__version__,
+                   stages={})
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        sources = make_synthetic(tmp, n_locations, n_dates, seed)
+        results['generate_seconds'] = time.perf_counter() - start
+
+        outputs = {}
+        for name, stage in pipeline_stages(sources, legacy):
+            outputs[name], results['stages'][name] = \
+                measure(lambda: stage(outputs), repeat)
+            print(name, results['stages'][name], file=sys.stderr)
+
+        daily = make_daily(os.path.join(tmp, 'daily'), sources)
+        _, results['stages']['ingest_daily'] = \
+            measure(lambda: data.ingest_daily(daily), repeat)
+        print('ingest_daily', results['stages']['ingest_daily'],
+              file=sys.stderr)
+
+        dataset = data.load(sources=sources,
+                            snapshot_dir=os.path.join(tmp, 'snap'))
+        results['master_bytes'] = \
+            data.memory_report(dataset).loc['Total'].to_dict()
+        for name, stage in callback_stages():
+            outputs[name], results['stages'][name] = \
+                measure(lambda: stage(outputs), repeat)
+            print(name, results['stages'][name], file=sys.stderr)
+
+    results['max_rss_mb'] = \
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return results
+
+
+def main():
+    """
+    Runs the benchmark with the sizes given on the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('--locations', type=int, default=500)
+    parser.add_argument('--dates', type=int, default=60)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-legacy', dest='legacy', action='store_false',
+                        help='skip the old county removal, melt and merge '
+                        'stages')
+    parser.add_argument('--out', default='bench_output.json')
+    args = parser.parse_args()
+
+    results = run(args.locations, args.dates, args.repeat, args.legacy,
+                  args.seed)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Keeps a size-bounded, least recently used cache of rendered figures so that
+repeat requests for the same figure are served from memory.
+"""
+from collections import OrderedDict
+import threading
+
+
+class LRUCache:
+    """
+    A dictionary-like cache holding at most maxsize entries, dropping the
+    least recently used entry when full. Counts hits and misses so the cache
+    can be monitored.
+    """
+    def __init__(self, maxsize=128):
+        """
+        Takes the largest number of entries to keep.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """
+        Takes a key and a function of no arguments. Returns the value cached
+        under key, or calls build, caches its result and returns it.
+        """
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+        value = build()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        """
+        Removes every entry, keeping the hit and miss counts.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def prune(self, keep):
+        """
+        Takes a function of a key and removes every entry whose key it
+        returns False for, keeping the hit and miss counts.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if not keep(key)]:
+                del self._entries[key]
+
+    def info(self):
+        """
+        Returns a dictionary with the hit and miss counts, the maximum size,
+        and the current number of entries.
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        maxsize=self.maxsize, currsize=len(self._entries))
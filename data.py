@@ -4,23 +4,144 @@ Final Project
 3/12/20
 Program requests and stores data from a github repo, transforms and cleans data
 for processing, calcultaes aggregate statistics.
+
+Importing this module does not read or download anything. Call load() to get
+the current Dataset, which is read from a memory-mapped snapshot of the
+processed arrays whenever the csv files have not changed since the last load.
+Running this file downloads the latest csv files and rebuilds the snapshot.
 """
 # imports for data handling
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import cached_property
+import hashlib
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
-import math
-import plotly.graph_objects as go
+import numpy as np
+from scipy import sparse
+import metrics
+
+# Names of the count arrays stored for each location and date.
+METRICS = ['Confirmed', 'Deaths', 'Recovered']
+
+# US states, along with the cruise ships counted like states.
+US_STATES = ('Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California',
+             'Colorado', 'Connecticut', 'Delaware', 'Florida', 'Georgia',
+             'Hawaii', 'Idaho', 'Illinois', 'Indiana', 'Iowa', 'Kansas',
+             'Kentucky', 'Louisiana', 'Maine', 'Maryland', 'Massachusetts',
+             'Michigan', 'Minnesota', 'Mississippi', 'Missouri', 'Montana',
+             'Nebraska', 'Nevada', 'New Hampshire', 'New Jersey',
+             'New Mexico', 'New York', 'North Carolina', 'North Dakota',
+             'Ohio', 'Oklahoma', 'Oregon', 'Pennsylvania', 'Rhode Island',
+             'South Carolina', 'South Dakota', 'Tennessee', 'Texas', 'Utah',
+             'Vermont', 'Virginia', 'Washington', 'West Virginia',
+             'Wisconsin', 'Wyoming', 'District of Columbia',
+             'Diamond Princess', 'Grand Princess')
+
+# Two letter codes used in the names of US counties, such as 'King County,
+# WA', mapped to the state each one stands for.
+STATE_CODES = dict(zip(
+    ('AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'FL', 'GA', 'HI', 'ID',
+     'IL', 'IN', 'IA', 'KS', 'KY', 'LA', 'ME', 'MD', 'MA', 'MI', 'MN', 'MS',
+     'MO', 'MT', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND', 'OH', 'OK',
+     'OR', 'PA', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV',
+     'WI', 'WY', 'D.C.'),
+    US_STATES[:51]))
+
+# Columns that identify a location, and the columns describing it.
+KEY_COLS = ['Province/State', 'Country/Region']
+ID_COLS = ['Province/State', 'Country/Region', 'Lat', 'Long']
+
+# Levels of the region hierarchy, from the largest regions to the smallest.
+LEVELS = ['Country/Region', 'Province/State', 'County']
+
+# Sizes in degrees of the grid cells locations are clustered into on the
+# map, from the coarsest level of detail to the finest, and the most
+# markers the map is drawn with.
+MAP_CELLS = (10.0, 2.5, 0.5)
+MAX_MARKERS = 2000
+
+# Number of leading locations and countries kept for every date and metric.
+TOP_N = 10
 
 
 # Various methods used for data handling
-def get_data(url, file_name):
+def get_data(url, file_name, session=requests):
     """
     Takes a url and file name to write to, and stores the
-    requested data in the file name specified.
+    requested data in the file name specified. The ETag and Last-Modified
+    headers of the response are kept in a .meta file next to it and sent
+    back on the next request, so unchanged data is not downloaded again.
+    The data is written to a temporary file that is then renamed into
+    place, so the file is never seen half written. Returns True if the file
+    changed and False if the server reported it unchanged.
     """
-    r = requests.get(url, allow_redirects=True)
-    with open(file_name, 'wb') as f:
-        f.write(r.content)
+    meta_name = file_name + '.meta'
+    meta = {}
+    if os.path.exists(file_name) and os.path.exists(meta_name):
+        with open(meta_name) as f:
+            meta = json.load(f)
+        if meta.get('url') != url:
+            meta = {}
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    r = session.get(url, headers=headers, allow_redirects=True, timeout=60)
+    if r.status_code == 304:
+        return False
+    r.raise_for_status()
+    write_atomic(file_name, r.content)
+    meta = dict(url=url, etag=r.headers.get('ETag'),
+                last_modified=r.headers.get('Last-Modified'))
+    write_atomic(meta_name, json.dumps(meta).encode())
+    return True
+
+
+def write_atomic(file_name, content):
+    """
+    Takes a file name and bytes, and writes the bytes to a temporary file in
+    the same folder before renaming it to the file name.
+    """
+    folder = os.path.dirname(os.path.abspath(file_name))
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, file_name)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+@metrics.stage('fetch')
+def fetch_all(sources):
+    """
+    Takes a list of (metric, url, file name) sources and downloads all of
+    them in parallel over one pooled session with get_data. Returns True if
+    any of the files changed, and False when there are no sources.
+    """
+    if not sources:
+        return False
+    with requests.Session() as session:
+        adapter = HTTPAdapter(pool_maxsize=len(sources))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+            changed = pool.map(lambda source: get_data(source[1], source[2],
+                                                       session),
+                               sources)
+            return any(list(changed))
 
 
 def pd_0(file_name):
@@ -29,7 +150,8 @@ def pd_0(file_name):
     with any na values filled with 0.
     """
     frame = pd.read_csv(file_name)
-    frame.fillna(0)
+    date_cols = frame.columns.difference(ID_COLS)
+    frame[date_cols] = frame[date_cols].fillna(0)
     return frame
 
 
@@ -45,26 +167,16 @@ def log_unless_0(input):
         return math.log(input)
 
 
+@metrics.stage('remove_us_counties')
 def remove_us_counties(df):
     """
     Takes a dataframe as input and returns a modified version of the dataframe,
     where any loction that is both in the US and not a state is removed. This
     was implemented due to the discontinuation of data updates for counties in
-    Johns Hopkins' Dataset.
-    """
-    states = ('Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California',
-              'Colorado', 'Connecticut', 'Delaware', 'Florida', 'Georgia',
-              'Hawaii', 'Idaho', 'Illinois', 'Indiana', 'Iowa', 'Kansas',
-              'Kentucky', 'Louisiana', 'Maine', 'Maryland', 'Massachusetts',
-              'Michigan', 'Minnesota', 'Mississippi', 'Missouri', 'Montana',
-              'Nebraska', 'Nevada', 'New Hampshire', 'New Jersey',
-              'New Mexico', 'New York', 'North Carolina', 'North Dakota',
-              'Ohio', 'Oklahoma', 'Oregon', 'Pennsylvania', 'Rhode Island',
-              'South Carolina', 'South Dakota', 'Tennessee', 'Texas', 'Utah',
-              'Vermont', 'Virginia', 'Washington', 'West Virginia',
-              'Wisconsin', 'Wyoming', 'District of Columbia',
-              'Diamond Princess', 'Grand Princess')
-    not_state = (df['Province/State'].isin(states))
+    Johns Hopkins' Dataset. Loading now keeps counties in the Hierarchy
+    instead, so this is only used to compare against in the benchmark.
+    """
+    not_state = (df['Province/State'].isin(US_STATES))
     is_us = df['Country/Region'] == 'US'
     is_not_us = df['Country/Region'] != 'US'
     return df[((not_state) & (is_us)) | (is_not_us)]
@@ -83,6 +195,1310 @@ def melter(df, value_col, id_cols):
                    var_name='date', value_name=value_col)
 
 
+class Store:
+    """
+    Holds the counts for every location and date in a single array of shape
+    (locations, dates, metrics), along with lookup tables that map a location
+    key or a date string to its position in the array.
+    """
+    def __init__(self, locations, dates, counts, key_cols=KEY_COLS,
+                 metrics=METRICS):
+        """
+        Takes a dataframe describing each location, a list of date strings,
+        the count array, the columns of the location table that make up its
+        key, and the names of the metrics along the last axis.
+        """
+        self.locations = locations.reset_index(drop=True)
+        self.dates = list(dates)
+        self.counts = counts
+        self.key_cols = list(key_cols)
+        self.metrics = list(metrics)
+        self.date_index = pd.Index(self.dates)
+
+    @cached_property
+    def location_index(self):
+        """
+        Index of the key of each location, built the first time it is used
+        since Stores made for a few dates at a time never look it up.
+        """
+        return location_keys(self.locations, self.key_cols)
+
+    def metric(self, name):
+        """
+        Takes a metric name and returns its (locations, dates) count array.
+        """
+        return self.counts[:, :, self.metrics.index(name)]
+
+    def date_frame(self, date):
+        """
+        Takes a date string and returns a dataframe with one row per location
+        holding its counts on that date.
+        """
+        i = self.date_index.get_loc(date)
+        frame = self.locations.copy()
+        frame['date'] = date
+        for k, name in enumerate(self.metrics):
+            frame[name] = self.counts[:, i, k]
+        return frame
+
+    def to_frame(self, order=None):
+        """
+        Returns a long dataframe with one row per location and date. Rows are
+        grouped by location, with all of a location's dates next to each
+        other, and locations follow the given order of positions (or the
+        order of the location table if no order is given).
+        Location names are categoricals, coordinates are float32, and each
+        date is stored as its position in the list of dates in a day column.
+        """
+        if order is None:
+            order = np.arange(len(self.locations))
+        n_dates = len(self.dates)
+        frame = pd.DataFrame({
+            col: repeat_column(self.locations[col], order, n_dates)
+            for col in self.locations.columns
+        })
+        frame['day'] = np.tile(np.arange(n_dates, dtype=np.int16),
+                               len(order))
+        flat = self.counts[order].reshape(-1, len(self.metrics))
+        for k, name in enumerate(self.metrics):
+            frame[name] = flat[:, k]
+        return frame
+
+    @metrics.stage('rollup')
+    def rollup(self, by):
+        """
+        Takes the name of a column of the location table, or a named series
+        giving a group for each location (such as a continent or a custom
+        region), and returns a new Store where the counts of every location
+        in the same group have been summed together. Locations whose group
+        is missing are left out. All metrics and dates are summed at once
+        by multiplying the counts by a sparse membership matrix.
+        """
+        if isinstance(by, str):
+            by = self.locations[by]
+        groups, matrix = membership(by.to_numpy())
+        n_locations = self.counts.shape[0]
+        flat = np.asarray(self.counts).reshape(n_locations, -1)
+        counts = matrix @ flat
+        counts = counts.astype(count_dtype(counts))
+        locations = pd.DataFrame({by.name: groups})
+        locations['Lat'], locations['Long'] = \
+            representative_coords(self.locations, matrix).T
+        return Store(locations, self.dates,
+                     counts.reshape((len(groups),) + self.counts.shape[1:]),
+                     [by.name], self.metrics)
+
+
+def membership(labels):
+    """
+    Takes an array with the group of each location and returns the sorted
+    groups, along with a sparse (groups, locations) matrix holding a 1
+    wherever a location belongs to a group.
+    """
+    codes, groups = pd.factorize(labels, sort=True)
+    members = np.flatnonzero(codes >= 0)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(members), dtype=np.int64), (codes[members], members)),
+        shape=(len(groups), len(labels)))
+    return groups, matrix
+
+
+def representative_coords(locations, matrix):
+    """
+    Takes a location dataframe and a membership matrix for it, and returns
+    a (groups, 2) array with the Lat and Long to show each group at. A group
+    that contains the row for a country as a whole (with no Province/State,
+    or one named after the country) is shown there; otherwise it is shown at
+    the mean of its members.
+    """
+    if 'Province/State' in locations:
+        province = locations['Province/State']
+        main = (province.isna() |
+                (province == locations['Country/Region'])).to_numpy(float)
+    else:
+        main = np.zeros(len(locations))
+    has_main = (matrix @ main) > 0
+    rows, cols = matrix.nonzero()
+    weights = sparse.csr_matrix(
+        (np.where(has_main[rows], main[cols], 1.0), (rows, cols)),
+        shape=matrix.shape)
+    totals = np.asarray(weights.sum(axis=1)).reshape(-1, 1)
+    coords = locations[['Lat', 'Long']].to_numpy(dtype=float)
+    return (weights @ coords) / np.maximum(totals, 1)
+
+
+def repeat_column(values, order, n):
+    """
+    Takes a column of a location table, an order of positions, and a number
+    of times to repeat each value. Returns the column in that order with
+    each value repeated, as a categorical for names and as float32 for
+    coordinates.
+    """
+    if pd.api.types.is_numeric_dtype(values):
+        return np.repeat(values.to_numpy(dtype=np.float32)[order], n)
+    codes, categories = pd.factorize(values)
+    return pd.Categorical.from_codes(np.repeat(codes[order], n), categories)
+
+
+def count_dtype(values):
+    """
+    Takes an array of counts and returns the narrowest integer type that
+    holds every one of them.
+    """
+    if values.size == 0:
+        return np.dtype(np.int8)
+    low, high = values.min(), values.max()
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def location_keys(locations, key_cols):
+    """
+    Takes a location dataframe and the columns that make up its key, and
+    returns an index of key tuples with missing values replaced by ''.
+    """
+    return pd.MultiIndex.from_frame(locations[key_cols].fillna(''))
+
+
+def date_columns(df):
+    """
+    Takes a wide dataframe and returns the list of its date column names.
+    """
+    return [col for col in df.columns if col not in ID_COLS]
+
+
+@metrics.stage('build_store')
+def build_store(frames):
+    """
+    Takes a dictionary mapping metric names to wide dataframes and returns a
+    Store holding all of them. Rows are matched on their location key and
+    columns on their date, so the files do not need to share an order.
+    Counts missing from one of the files are filled with 0, and counts are
+    stored in the narrowest integer type that holds them.
+    """
+    metrics = list(frames)
+    locations = unique_locations([df[ID_COLS] for df in frames.values()])
+    dates = sorted_dates(frames)
+    values = [df[date_columns(df)].to_numpy(dtype=np.int64)
+              for df in frames.values()]
+    dtype = np.result_type(*[count_dtype(v) for v in values])
+    store = Store(locations, dates,
+                  np.zeros((len(locations), len(dates), len(metrics)),
+                           dtype=dtype),
+                  KEY_COLS, metrics)
+    for k, df in enumerate(frames.values()):
+        rows = store.location_index.get_indexer(location_keys(df, KEY_COLS))
+        cols = store.date_index.get_indexer(date_columns(df))
+        store.counts[np.ix_(rows, cols, [k])] = values[k][:, :, np.newaxis]
+    return store
+
+
+def unique_locations(tables):
+    """
+    Takes a list of location dataframes and returns one dataframe holding
+    the first row seen for every location key.
+    """
+    locations = pd.concat(tables)
+    keys = location_keys(locations, KEY_COLS)
+    return locations[~keys.duplicated()]
+
+
+def sorted_dates(frames):
+    """
+    Takes a dictionary of wide dataframes and returns every date column that
+    appears in any of them, in chronological order.
+    """
+    all_dates = pd.Index([])
+    for df in frames.values():
+        all_dates = all_dates.union(pd.Index(date_columns(df)), sort=False)
+    parsed = pd.to_datetime(all_dates, format='%m/%d/%y')
+    return list(all_dates[np.argsort(parsed, kind='stable')])
+
+
+@metrics.stage('update_store')
+def update_store(store, frames):
+    """
+    Takes a Store and a dictionary of wide dataframes holding the same
+    metrics, usually newer versions of the files the store was built from.
+    Returns the Store built from the new files, the same as build_store
+    would, along with the positions of the dates whose counts changed. When
+    the new files start with the old locations and dates in the old order,
+    only the dates where some count differs from the old store, and any
+    new dates, are reported as changed. Otherwise, such as when a location
+    was renamed or removed, every date is reported as changed.
+    """
+    updated = build_store(frames)
+    n_locations, n_dates = store.counts.shape[:2]
+    if list(frames) != store.metrics or \
+            updated.dates[:n_dates] != store.dates or \
+            not updated.location_index[:n_locations].equals(
+                store.location_index):
+        return updated, np.arange(len(updated.dates))
+
+    old = updated.counts[:n_locations, :n_dates]
+    changed = np.ones(len(updated.dates), dtype=bool)
+    changed[:n_dates] = ((old != store.counts).any(axis=(0, 2)) |
+                         (updated.counts[n_locations:, :n_dates] != 0)
+                         .any(axis=(0, 2)))
+    return updated, np.flatnonzero(changed)
+
+
+@metrics.stage('merge_store')
+def merge_store(store, frames):
+    """
+    Takes a Store and a dictionary of wide dataframes holding the same
+    metrics, such as the daily reports of more dates, and returns a Store
+    holding both. Counts in the dataframes replace those of the store for
+    the same location and date, while locations and dates missing from
+    them keep their counts from the store. Dates are kept in chronological
+    order.
+    """
+    locations = unique_locations([store.locations] +
+                                 [df[ID_COLS] for df in frames.values()])
+    dates = store.dates + [date for date in sorted_dates(frames)
+                           if date not in store.date_index]
+    parsed = pd.to_datetime(dates, format='%m/%d/%y')
+    dates = [dates[i] for i in np.argsort(parsed, kind='stable')]
+    values = [df[date_columns(df)].to_numpy(dtype=np.int64)
+              for df in frames.values()]
+    dtype = np.result_type(store.counts.dtype,
+                           *[count_dtype(v) for v in values])
+    merged = Store(locations, dates,
+                   np.zeros((len(locations), len(dates), len(store.metrics)),
+                            dtype=dtype),
+                   store.key_cols, store.metrics)
+    merged.counts[np.ix_(merged.location_index.get_indexer(
+                             store.location_index),
+                         merged.date_index.get_indexer(store.dates))] = \
+        store.counts
+    for k, df in enumerate(frames.values()):
+        rows = merged.location_index.get_indexer(location_keys(df, KEY_COLS))
+        cols = merged.date_index.get_indexer(date_columns(df))
+        merged.counts[np.ix_(rows, cols, [k])] = values[k][:, :, np.newaxis]
+    return merged
+
+
+def update_rollup(rollup, store, changed, by=None):
+    """
+    Takes a Store of totals previously returned by rollup, the updated Store
+    it was computed from, the positions of the dates whose counts changed,
+    and optionally the series of groups it was rolled up by (the column of
+    the location table it is keyed on if not given). Returns the totals for
+    the updated Store, recomputing only the changed dates when the set of
+    groups and the earlier dates are the same as before.
+    """
+    if by is None:
+        by = store.locations[rollup.key_cols[0]]
+    _, groups = pd.factorize(by, sort=True)
+    if not pd.Index(groups).equals(
+            rollup.location_index.get_level_values(0)) or \
+            store.dates[:len(rollup.dates)] != rollup.dates:
+        return store.rollup(by)
+    part = date_slice(store, changed).rollup(by)
+    return Store(part.locations, store.dates,
+                 splice(rollup.counts, part.counts, changed,
+                        len(store.dates)),
+                 rollup.key_cols, store.metrics)
+
+
+def date_slice(store, days):
+    """
+    Takes a Store and the positions of some of its dates, and returns a
+    Store of the same locations holding only those dates.
+    """
+    return Store(store.locations, [store.dates[i] for i in days],
+                 store.counts[:, days], store.key_cols, store.metrics)
+
+
+def splice(old, part, changed, n_dates, axis=1):
+    """
+    Takes an array computed for the earlier dates of a Store, the same
+    array computed for only the dates whose counts changed, the positions
+    of those dates, the number of dates in the updated Store, and the axis
+    the dates run along. Returns the array for every date, keeping the old
+    values of the dates that did not change.
+    """
+    shape = list(old.shape)
+    shape[axis] = n_dates
+    spliced = np.zeros(shape, dtype=np.result_type(old.dtype, part.dtype))
+    before = (slice(None),) * axis
+    spliced[before + (slice(0, old.shape[axis]),)] = old
+    spliced[before + (changed,)] = part
+    return spliced
+
+
+def same_locations(store, updated):
+    """
+    Takes a Store and the Store returned by update_store for it, and
+    returns whether the updated Store holds the same locations in the same
+    order, with the old dates first, so arrays computed for the old Store
+    can be extended with splice.
+    """
+    return (updated.location_index.equals(store.location_index) and
+            updated.dates[:len(store.dates)] == store.dates)
+
+
+def fill_province(df):
+    """
+    Takes a dataframe and fills any missing Province/State with the
+    Country/Region of that row, so every location has a display name.
+    """
+    df.loc[df['Province/State'].isnull(),
+           'Province/State'] = df['Country/Region']
+    return df
+
+
+def region_paths(locations):
+    """
+    Takes a location dataframe and returns a dataframe with the
+    Country/Region, Province/State and County of each location, holding ''
+    for the levels a location does not reach. US locations named like
+    'King County, WA' are counties of the state their code stands for.
+    """
+    province = locations['Province/State'].fillna('').astype(str).str.strip()
+    country = locations['Country/Region'].fillna('').astype(str)
+    state = province.str.rsplit(', ', n=1).str[-1].map(STATE_CODES)
+    is_county = ((country == 'US') & province.str.contains(', ', regex=False)
+                 & state.notna())
+    return pd.DataFrame({
+        'Country/Region': country,
+        'Province/State': province.where(~is_county, state),
+        'County': province.where(is_county, ''),
+    }).reset_index(drop=True)
+
+
+class Hierarchy:
+    """
+    The tree of regions the locations of a Store belong to: every country,
+    the provinces or states in it, and the counties in each US state. Each
+    location is a leaf under the smallest region it names, so a state's
+    own row and its counties are all leaves of the state.
+
+    Regions are kept in depth-first order, so every region is followed by
+    all of its descendants and they can be looked up as a range. Totals are
+    only ever summed from the leaves, so no count is added twice.
+    """
+    def __init__(self, locations):
+        """
+        Takes the location dataframe of a Store.
+        """
+        paths = region_paths(locations)
+        prefixes = []
+        for depth, level in enumerate(LEVELS, 1):
+            prefix = paths[paths[level] != ''].copy()
+            prefix[LEVELS[depth:]] = ''
+            prefixes.append(prefix)
+        nodes = pd.concat(prefixes).drop_duplicates().sort_values(LEVELS)
+        nodes = nodes.reset_index(drop=True)
+        present = (nodes[LEVELS] != '').to_numpy()
+        nodes['depth'] = present.sum(axis=1)
+        nodes['name'] = nodes[LEVELS].to_numpy()[np.arange(len(nodes)),
+                                                   nodes['depth'] - 1]
+        nodes['key'] = [' / '.join(part for part in path if part)
+                        for path in nodes[LEVELS].itertuples(index=False)]
+
+        end = np.zeros(len(nodes), dtype=np.int64)
+        for depth in range(1, len(LEVELS) + 1):
+            groups = nodes.groupby(LEVELS[:depth], sort=False).ngroup()
+            ends = np.searchsorted(groups, groups, side='right')
+            end[nodes['depth'] == depth] = ends[nodes['depth'] == depth]
+        self.nodes = nodes
+        self.end = end
+        self.index = pd.MultiIndex.from_frame(nodes[LEVELS])
+        self.keys = pd.Index(nodes['key'])
+        self.names = nodes.groupby('name', sort=False).indices
+        self.locations = locations
+
+        rows, cols = [], []
+        for prefix in prefixes:
+            rows.append(self.index.get_indexer(
+                pd.MultiIndex.from_frame(prefix[LEVELS])))
+            cols.append(prefix.index.to_numpy())
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        self.matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int64), (rows, cols)),
+            shape=(len(nodes), len(paths)))
+
+    def find(self, name):
+        """
+        Takes the name of a region, such as 'Washington', and returns the
+        positions of every region with that name, largest regions first.
+        """
+        positions = self.names.get(name, np.zeros(0, dtype=np.int64))
+        return positions[np.argsort(self.nodes['depth'].to_numpy()[positions],
+                                    kind='stable')]
+
+    def position(self, key):
+        """
+        Takes the key of a region, such as 'US / Washington', and returns
+        its position, or -1 if there is no such region.
+        """
+        return self.keys.get_indexer([key])[0]
+
+    def descendants(self, node):
+        """
+        Takes the position of a region and returns the rows of nodes for
+        every region inside it.
+        """
+        return self.nodes.iloc[node + 1:self.end[node]]
+
+    def leaves(self, node):
+        """
+        Takes the position of a region and returns the positions of the
+        Store locations inside it.
+        """
+        return self.matrix[node].indices
+
+    @metrics.stage('regions')
+    def rollup(self, store):
+        """
+        Takes the Store the hierarchy was built from and returns a Store of
+        the totals of every region, in the same order as nodes, summed from
+        the leaves by multiplying the counts by the sparse matrix of which
+        locations each region holds.
+        """
+        n_locations = store.counts.shape[0]
+        counts = self.matrix @ np.asarray(store.counts).reshape(n_locations,
+                                                                -1)
+        counts = counts.astype(count_dtype(counts))
+        locations = self.nodes[LEVELS].where(self.nodes[LEVELS] != '')
+        locations['Lat'], locations['Long'] = \
+            representative_coords(store.locations, self.matrix).T
+        return Store(locations, store.dates,
+                     counts.reshape((len(locations),) +
+                                    store.counts.shape[1:]),
+                     LEVELS, store.metrics)
+
+
+def grid_cells(locations, size):
+    """
+    Takes a location dataframe and a cell size in degrees, and returns the
+    number of the grid cell each location falls in, or NaN for locations
+    without coordinates.
+    """
+    row = np.floor((locations['Lat'].to_numpy(dtype=float) + 90) / size)
+    col = np.floor((locations['Long'].to_numpy(dtype=float) + 180) / size)
+    return row * math.ceil(360 / size) + col
+
+
+class MapLayer:
+    """
+    One level of detail of the map: a Store of markers, which are either
+    single locations or clusters of nearby ones, along with the name shown
+    for each marker and its derived metrics.
+    """
+    def __init__(self, store, names, derived=None):
+        """
+        Takes a Store of markers, the name of each marker, and optionally
+        the derived metrics of the store (computed if not given).
+        """
+        if derived is None:
+            derived = compute_derived(store)
+        self.store = store
+        self.names = np.asarray(names, dtype=object)
+        self.derived = derived
+        self.lat = store.locations['Lat'].to_numpy(dtype=np.float32)
+        self.long = store.locations['Long'].to_numpy(dtype=np.float32)
+
+    def visible(self, bounds=None):
+        """
+        Takes optional (south, north, west, east) bounds in degrees, where
+        west may be below -180 or east above 180, and returns the positions
+        of the markers inside them, or of every marker if no bounds are
+        given.
+        """
+        if bounds is None:
+            return np.arange(len(self.names))
+        south, north, west, east = bounds
+        inside = (self.lat >= south) & (self.lat <= north)
+        if east - west < 360:
+            # Measuring east from the west bound handles views that cross
+            # the antimeridian, where west or east run past 180 degrees.
+            inside &= (self.long - west) % 360 <= east - west
+        return np.flatnonzero(inside)
+
+
+def cluster_names(names, matrix, confirmed):
+    """
+    Takes the name of each location, a membership matrix grouping them into
+    clusters, and each location's confirmed cases. Returns the name of each
+    cluster: the name of its location with the most cases, followed by how
+    many other locations it holds.
+    """
+    clusters, members = matrix.nonzero()
+    if len(clusters) == 0:
+        return []
+    order = np.lexsort((-np.asarray(confirmed)[members], clusters))
+    clusters, members = clusters[order], members[order]
+    first = np.r_[True, clusters[1:] != clusters[:-1]]
+    sizes = np.diff(np.r_[np.flatnonzero(first), len(clusters)])
+    leaders = np.asarray(names, dtype=object)[members[first]]
+    return [leader if size == 1 else
+            leader + ' and ' + str(size - 1) + ' more'
+            for leader, size in zip(leaders, sizes)]
+
+
+class SpatialIndex:
+    """
+    The map at several levels of detail, built once per Dataset. Each
+    coarse level sums the locations in every grid cell of one of the
+    MAP_CELLS sizes into a single marker shown at the cell's main location,
+    and the finest level holds every location as its own marker. The map
+    is drawn at the finest level that keeps the markers in view under a
+    limit, so its size stays bounded however many locations are loaded.
+    """
+    def __init__(self, store, derived=None, cell_sizes=MAP_CELLS,
+                 coarse=None):
+        """
+        Takes a Store of locations, optionally its derived metrics, the grid
+        cell sizes of the coarse levels, largest first, and optionally the
+        MapLayers of the coarse levels if they have already been built.
+        """
+        names = display_names(store.locations)
+        if coarse is not None:
+            self.layers = list(coarse) + [MapLayer(store, names, derived)]
+            return
+        confirmed = store.metric('Confirmed')[:, -1]
+        self.layers = []
+        for size in cell_sizes:
+            cells = pd.Series(grid_cells(store.locations, size), name='cell')
+            _, matrix = membership(cells.to_numpy())
+            self.layers.append(MapLayer(
+                store.rollup(cells), cluster_names(names, matrix, confirmed)))
+        self.layers.append(MapLayer(store, names, derived))
+
+    def update(self, store, derived, changed, cell_sizes=MAP_CELLS):
+        """
+        Takes the updated Store and its derived metrics, the positions of
+        the dates whose counts changed, and the grid cell sizes of the
+        coarse levels, when the locations and their coordinates are the
+        same as before. Returns the SpatialIndex of the updated Store,
+        summing and deriving only the changed dates of the coarse levels.
+        """
+        names = display_names(store.locations)
+        confirmed = store.metric('Confirmed')[:, -1]
+        n_dates = len(store.dates)
+        coarse = []
+        for size, layer in zip(cell_sizes, self.layers):
+            cells = pd.Series(grid_cells(store.locations, size), name='cell')
+            _, matrix = membership(cells.to_numpy())
+            rollup = update_rollup(layer.store, store, changed, cells)
+            part = compute_derived(date_slice(rollup, changed))
+            coarse.append(MapLayer(
+                rollup, cluster_names(names, matrix, confirmed),
+                {name: splice(layer.derived[name], values, changed, n_dates)
+                 for name, values in part.items()}))
+        return SpatialIndex(store, derived, coarse=coarse)
+
+    def choose(self, bounds=None, max_markers=MAX_MARKERS):
+        """
+        Takes optional (south, north, west, east) bounds of the part of the
+        map in view and the most markers to show. Returns the position in
+        layers of the finest level with no more than that many markers in
+        view, or of the coarsest level if every level has more.
+        """
+        for level in range(len(self.layers) - 1, 0, -1):
+            if len(self.layers[level].visible(bounds)) <= max_markers:
+                return level
+        return 0
+
+
+# Derived metrics, each computed from the count arrays by a function
+# registered with the derived decorator.
+DERIVED = {}
+
+
+def derived(name):
+    """
+    Decorator that registers a function as the derived metric with the given
+    name. The function takes a dictionary mapping each metric name to its
+    (locations, dates) count array and returns an array of the same shape.
+    """
+    def register(function):
+        DERIVED[name] = function
+        return function
+    return register
+
+
+def ratio(numerator, denominator):
+    """
+    Takes two count arrays and returns numerator / denominator, with 0
+    wherever the denominator is 0. The division is done in float32 even
+    for narrow integer counts, which numpy would otherwise divide in
+    float16.
+    """
+    out = np.zeros(numerator.shape, dtype=np.float32)
+    np.divide(numerator, denominator, out=out, where=denominator != 0,
+              dtype=np.float32)
+    return out
+
+
+def log_size(counts):
+    """
+    Takes a count array and returns its natural log, with 0 wherever the
+    count is not positive. The array version of log_unless_0. The log is
+    taken in float32 even for narrow integer counts.
+    """
+    out = np.zeros(counts.shape, dtype=np.float32)
+    np.log(counts, out=out, where=counts > 0, dtype=np.float32)
+    return out
+
+
+@derived('percent_deaths')
+def percent_deaths(counts):
+    """
+    Share of confirmed cases that died.
+    """
+    return ratio(counts['Deaths'], counts['Confirmed'])
+
+
+@derived('percent_recovered')
+def percent_recovered(counts):
+    """
+    Share of confirmed cases that recovered.
+    """
+    return ratio(counts['Recovered'], counts['Confirmed'])
+
+
+@derived('Confirmed_Size')
+def confirmed_size(counts):
+    """
+    Marker size for the maps, the log of confirmed cases.
+    """
+    return log_size(counts['Confirmed'])
+
+
+@derived('Deaths_Color')
+def deaths_color(counts):
+    """
+    Marker color for the maps, the log of deaths.
+    """
+    return log_size(counts['Deaths'])
+
+
+@derived('Active')
+def active(counts):
+    """
+    Cases that have neither died nor recovered.
+    """
+    active = (counts['Confirmed'].astype(np.int64) - counts['Deaths'] -
+              counts['Recovered'])
+    return active.astype(count_dtype(active))
+
+
+@metrics.stage('derived')
+def compute_derived(store):
+    """
+    Takes a Store and returns a dictionary mapping each registered derived
+    metric to its (locations, dates) array.
+    """
+    counts = {name: store.metric(name) for name in store.metrics}
+    return {name: function(counts) for name, function in DERIVED.items()}
+
+
+def display_names(locations):
+    """
+    Takes a location dataframe and returns the name each location is shown
+    under, which is its Province/State or else its Country/Region.
+    """
+    return locations['Province/State'].fillna(locations['Country/Region'])
+
+
+def location_slices(names, n_dates):
+    """
+    Takes the display names of the locations in the order they appear in
+    master, where locations sharing a name are next to each other, and the
+    number of dates per location. Returns a dictionary mapping each name to
+    the slice of master rows holding its data.
+    """
+    names = np.asarray(names, dtype=object)
+    starts = np.flatnonzero(np.r_[True, names[1:] != names[:-1]])
+    ends = np.r_[starts[1:], len(names)]
+    return {names[start]: slice(start * n_dates, end * n_dates)
+            for start, end in zip(starts, ends)}
+
+
+@metrics.stage('master')
+def master_frame(store, derived=None):
+    """
+    Takes a Store and optionally its derived metrics from compute_derived,
+    and returns the long dataframe used by the dashboard, with one row per
+    location and date plus the derived columns, along with a dictionary
+    mapping each location name to its slice of rows. Missing Province/State
+    names are filled with the Country/Region.
+    """
+    names = display_names(store.locations)
+    codes, _ = pd.factorize(names)
+    order = np.argsort(codes, kind='stable')
+    master = store.to_frame(order)
+    master['Province/State'] = repeat_column(names, order, len(store.dates))
+    index = location_slices(names.iloc[order], len(store.dates))
+
+    if derived is None:
+        derived = compute_derived(store)
+    for name, values in derived.items():
+        master[name] = values[order].reshape(-1)
+    return master, index
+
+
+def legacy_frame(master, dates):
+    """
+    Takes master and its list of date strings, and returns master in the
+    layout it had before it was made compact: names as Python strings,
+    counts as int64, coordinates and ratios as float64, and every date held
+    both as a string in a date column and as a datetime in a date_time
+    column.
+    """
+    frame = pd.DataFrame(index=master.index)
+    for col in master.columns.drop('day'):
+        values = master[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            frame[col] = values.astype(object)
+        elif pd.api.types.is_integer_dtype(values):
+            frame[col] = values.astype(np.int64)
+        else:
+            frame[col] = values.astype(np.float64)
+    frame.insert(4, 'date', np.asarray(dates, dtype=object)[master['day']])
+    frame['date_time'] = pd.to_datetime(frame['date'], format='%m/%d/%y')
+    return frame
+
+
+def memory_report(dataset):
+    """
+    Takes a Dataset and returns a dataframe with the bytes used by each
+    column of master in its compact layout and in the old layout, with the
+    totals in the last row.
+    """
+    compact = dataset.master.memory_usage(index=False, deep=True)
+    legacy = legacy_frame(dataset.master, dataset.dates).memory_usage(
+        index=False, deep=True)
+    report = pd.DataFrame({'compact': compact, 'legacy': legacy},
+                          index=compact.index.union(legacy.index, sort=False))
+    report = report.fillna(0).astype(np.int64)
+    report.loc['Total'] = report.sum()
+    return report
+
+
+def store_version(store):
+    """
+    Takes a Store and returns a short hash of its locations, dates and
+    counts, which changes whenever any of the data does.
+    """
+    digest = hashlib.sha1()
+    digest.update(repr(list(store.location_index)).encode())
+    digest.update(','.join(store.dates).encode())
+    digest.update(np.ascontiguousarray(store.counts).tobytes())
+    return digest.hexdigest()[:12]
+
+
+def save_store(store, path):
+    """
+    Takes a Store and a directory path, and writes the store into the
+    directory as .npy files and a small json description, so that it can be
+    reopened with open_store.
+    """
+    os.makedirs(path)
+    np.save(os.path.join(path, 'counts.npy'), store.counts)
+    for i, col in enumerate(store.locations.columns):
+        values = store.locations[col]
+        if pd.api.types.is_numeric_dtype(values):
+            values = values.to_numpy()
+        else:
+            values = values.fillna('').to_numpy(dtype=str)
+        np.save(os.path.join(path, 'location_' + str(i) + '.npy'), values)
+    meta = dict(columns=list(store.locations.columns),
+                key_cols=store.key_cols, metrics=store.metrics,
+                dates=store.dates)
+    with open(os.path.join(path, 'store.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def open_store(path):
+    """
+    Takes a directory written by save_store and returns the Store saved in
+    it. The count array is memory-mapped read-only rather than read into
+    memory.
+    """
+    with open(os.path.join(path, 'store.json')) as f:
+        meta = json.load(f)
+    locations = {}
+    for i, col in enumerate(meta['columns']):
+        values = np.load(os.path.join(path, 'location_' + str(i) + '.npy'))
+        if values.dtype.kind == 'U':
+            values = pd.Series(values, dtype=object).where(values != '')
+        locations[col] = values
+    counts = np.load(os.path.join(path, 'counts.npy'), mmap_mode='r')
+    return Store(pd.DataFrame(locations), meta['dates'], counts,
+                 meta['key_cols'], meta['metrics'])
+
+
+def save_frame(frame, path):
+    """
+    Takes a dataframe of numeric and categorical columns and a directory
+    path, and writes each column into the directory as .npy files, with a
+    json list of the columns, so that it can be reopened with open_frame.
+    """
+    os.makedirs(path)
+    columns = []
+    for i, col in enumerate(frame.columns):
+        values = frame[col]
+        name = os.path.join(path, 'column_' + str(i))
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            np.save(name + '.npy', values.cat.codes.to_numpy())
+            np.save(name + '_categories.npy',
+                    values.cat.categories.to_numpy(dtype=str))
+            columns.append([col, 'category'])
+        else:
+            np.save(name + '.npy', values.to_numpy())
+            columns.append([col, 'array'])
+    with open(os.path.join(path, 'frame.json'), 'w') as f:
+        json.dump(columns, f)
+
+
+def open_frame(path):
+    """
+    Takes a directory written by save_frame and returns the dataframe saved
+    in it. Numeric columns are memory-mapped read-only and used without
+    copying, so processes opening the same frame share its memory.
+    """
+    with open(os.path.join(path, 'frame.json')) as f:
+        columns = json.load(f)
+    values = {}
+    for i, (col, kind) in enumerate(columns):
+        name = os.path.join(path, 'column_' + str(i))
+        values[col] = np.load(name + '.npy', mmap_mode='r')
+        if kind == 'category':
+            values[col] = pd.Categorical.from_codes(
+                values[col], np.load(name + '_categories.npy'))
+    return pd.DataFrame(values, copy=False)
+
+
+def save_summary(summary, path):
+    """
+    Takes a Summary and a directory path, and writes the summary into the
+    directory so that it can be reopened with open_summary.
+    """
+    save_store(summary.by_name, os.path.join(path, 'names'))
+    for name in ('totals', 'top_names', 'top_countries'):
+        np.save(os.path.join(path, name + '.npy'), getattr(summary, name))
+
+
+def open_summary(path, store_by_Country):
+    """
+    Takes a directory written by save_summary and the Store of country
+    totals it was computed with, and returns the memory-mapped Summary saved
+    in the directory.
+    """
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+              for name in ('totals', 'top_names', 'top_countries')}
+    return Summary(open_store(os.path.join(path, 'names')), store_by_Country,
+                   **arrays)
+
+
+def save_arrays(arrays, path):
+    """
+    Takes a dictionary mapping names to arrays and a directory path, and
+    writes each array into the directory as a .npy file named after it.
+    """
+    os.makedirs(path)
+    for name, values in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), values)
+
+
+def open_arrays(path, names):
+    """
+    Takes a directory written by save_arrays and the names of the arrays in
+    it, and returns a dictionary of the arrays memory-mapped read-only.
+    """
+    return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+            for name in names}
+
+
+def save_spatial(spatial, path):
+    """
+    Takes a SpatialIndex and a directory path, and writes the store, names
+    and derived metrics of each coarse level into the directory. The finest
+    level is the Dataset's own store and derived metrics, which are saved
+    with it.
+    """
+    for i, layer in enumerate(spatial.layers[:-1]):
+        folder = os.path.join(path, 'layer_' + str(i))
+        save_store(layer.store, os.path.join(folder, 'store'))
+        save_arrays(layer.derived, os.path.join(folder, 'derived'))
+        np.save(os.path.join(folder, 'names.npy'),
+                layer.names.astype(str))
+
+
+def open_spatial(path, store, derived):
+    """
+    Takes a directory written by save_spatial along with the Store and
+    derived metrics of the finest level, and returns the SpatialIndex with
+    every level's arrays memory-mapped.
+    """
+    coarse = []
+    for i in range(len(MAP_CELLS)):
+        folder = os.path.join(path, 'layer_' + str(i))
+        coarse.append(MapLayer(
+            open_store(os.path.join(folder, 'store')),
+            np.load(os.path.join(folder, 'names.npy')),
+            open_arrays(os.path.join(folder, 'derived'), DERIVED)))
+    return SpatialIndex(store, derived, coarse=coarse)
+
+
+def top_positions(counts, n, rank=None, chunk=64):
+    """
+    Takes a (locations, dates, metrics) count array, a number n, and
+    optionally the rank of each location for breaking ties (its position
+    if not given). Returns a (dates, metrics, n) array with the positions
+    of the n locations with the highest counts on each date for each
+    metric, highest first, with ties going to the location of lower rank.
+    Fewer positions are returned when there are fewer than n locations.
+
+    For each date and metric, every location tied with the n-th highest
+    count is kept as a candidate before the candidates are sorted, so ties
+    at the cut-off are broken by rank rather than arbitrarily. Dates are
+    ranked a chunk at a time to keep the temporary arrays small.
+    """
+    n_locations, n_dates, n_metrics = counts.shape
+    n = min(n, n_locations)
+    top = np.zeros((n_dates, n_metrics, n), dtype=np.int32)
+    if n == 0:
+        return top
+    if rank is None:
+        rank = np.arange(n_locations)
+    rank = np.asarray(rank)
+    for start in range(0, n_dates, chunk):
+        values = np.asarray(counts[:, start:start + chunk], dtype=np.int64)
+        n_days = values.shape[1]
+        cutoff = np.partition(values, n_locations - n,
+                              axis=0)[n_locations - n]
+        day, metric, position = np.nonzero(
+            (values >= cutoff).transpose(1, 2, 0))
+        column = day * n_metrics + metric
+        order = np.lexsort((rank[position], -values[position, day, metric],
+                            column))
+        firsts = np.searchsorted(column[order], np.arange(n_days * n_metrics))
+        best = position[order][firsts[:, np.newaxis] + np.arange(n)]
+        top[start:start + n_days] = best.reshape(n_days, n_metrics, n)
+    return top
+
+
+def name_rank(locations, by_name):
+    """
+    Takes a location dataframe and the Store of its counts summed by
+    display name, and returns the rank of each name for breaking ties
+    between names: where it is first seen in the locations, the way idxmax
+    did.
+    """
+    names = display_names(locations)
+    first = pd.Series(np.arange(len(names)),
+                      index=names.to_numpy()).groupby(level=0).min()
+    return first.reindex(by_name.location_index.get_level_values(0)).to_numpy()
+
+
+class Summary:
+    """
+    The summary statistics of a Dataset for every date and metric: the
+    world totals, the locations and countries with the highest counts, and
+    the counts of each location by the name it is shown under. Looking any
+    of them up only indexes into arrays computed once per version.
+    """
+    def __init__(self, by_name, store_by_Country, totals=None,
+                 top_names=None, top_countries=None, top=TOP_N,
+                 name_rank=None):
+        """
+        Takes a Store of counts summed by display name, the Store of country
+        totals, and optionally the (dates, metrics) array of world totals
+        and the arrays from top_positions ranking the names and countries
+        (computed from the stores if not given), how many leaders to keep,
+        and the rank of each name for breaking ties between names (their
+        order in by_name if not given).
+        """
+        if totals is None:
+            totals = np.asarray(by_name.counts).sum(axis=0, dtype=np.int64)
+        if top_names is None:
+            top_names = top_positions(by_name.counts, top, name_rank)
+        if top_countries is None:
+            top_countries = top_positions(store_by_Country.counts, top)
+        self.by_name = by_name
+        self.store_by_Country = store_by_Country
+        self.top = top
+        self.totals = totals
+        self.top_names = top_names
+        self.top_countries = top_countries
+        self.names = by_name.location_index.get_level_values(0)
+        self.countries = store_by_Country.location_index.get_level_values(0)
+
+    def update(self, store, store_by_Country, changed):
+        """
+        Takes the updated Store of provinces, the updated Store of country
+        totals, and the positions of the dates whose counts changed, when
+        the locations are the same as before. Returns the Summary of the
+        updated stores, recomputing only the changed dates.
+        """
+        by_name = update_rollup(self.by_name, store, changed,
+                                display_names(store.locations))
+        part = by_name.counts[:, changed]
+        n_dates = len(store.dates)
+        return Summary(
+            by_name, store_by_Country,
+            splice(self.totals, np.asarray(part).sum(axis=0, dtype=np.int64),
+                   changed, n_dates, axis=0),
+            splice(self.top_names,
+                   top_positions(part, self.top,
+                                 name_rank(store.locations, by_name)),
+                   changed, n_dates, axis=0),
+            splice(self.top_countries,
+                   top_positions(store_by_Country.counts[:, changed],
+                                 self.top),
+                   changed, n_dates, axis=0),
+            self.top)
+
+    def location(self, name, day):
+        """
+        Takes a display name, or 'Total' for the whole world, and the
+        position of a date. Returns a dictionary mapping each metric to the
+        location's count on that date, which is 0 for unknown names.
+        """
+        if name == 'Total':
+            values = self.totals[day]
+        else:
+            i = self.names.get_indexer([name])[0]
+            if i < 0:
+                values = np.zeros(len(self.by_name.metrics), dtype=np.int64)
+            else:
+                values = self.by_name.counts[i, day]
+        return {metric: int(value)
+                for metric, value in zip(self.by_name.metrics, values)}
+
+    def leaders(self, day, metric, by='Province/State', n=None):
+        """
+        Takes the position of a date, a metric name, whether to rank by
+        'Province/State' or 'Country/Region', and optionally how many
+        leaders to return. Returns the names with the highest counts of the
+        metric on that date, highest first.
+        """
+        k = self.by_name.metrics.index(metric)
+        if by == 'Country/Region':
+            return list(self.countries[self.top_countries[day, k, :n]])
+        return list(self.names[self.top_names[day, k, :n]])
+
+
+class Dataset:
+    """
+    One version of the loaded data: the store of provinces, the store of
+    country totals, and the summary statistics for every date. The long
+    dataframes are only built the first time they are used.
+    """
+    def __init__(self, store, store_by_Country=None, version=None,
+                 master=None, summary=None, regions=None, derived=None,
+                 folder=None, spatial=None):
+        """
+        Takes a Store of provinces, optionally the Store of country totals
+        (computed from the provinces if not given), optionally a version
+        string (a hash of the counts if not given), optionally master and
+        its location index, the Summary, the Store of region totals and the
+        derived metrics if they have already been built, the folder of
+        daily report files the data was read from, if it was not read from
+        the time series files, and the SpatialIndex if it has already been
+        built.
+        """
+        if store_by_Country is None:
+            store_by_Country = store.rollup('Country/Region')
+        if version is None:
+            version = store_version(store)
+        self.store = store
+        self.store_by_Country = store_by_Country
+        self.version = version
+        self.folder = folder
+        self.dates = np.array(store.dates, dtype=object)
+        if master is not None:
+            self._master = master
+        if regions is not None:
+            self.regions = regions
+        if derived is not None:
+            self.derived = derived
+        if spatial is not None:
+            self.spatial = spatial
+        self.summary = summary
+        self._summarize()
+
+    @metrics.stage('summaries')
+    def _summarize(self):
+        """
+        Computes the summary statistics for every date, unless they were
+        opened from a snapshot, and sets the leaders and world totals for
+        the latest date.
+        """
+        if self.summary is None:
+            by_name = self.store.rollup(display_names(self.store.locations))
+            self.summary = Summary(
+                by_name, self.store_by_Country,
+                name_rank=name_rank(self.store.locations, by_name))
+        leaders = [self.summary.leaders(-1, metric, by, 1)[0]
+                   for by in ('Province/State', 'Country/Region')
+                   for metric in METRICS]
+        (self.most_confirmed_province, self.most_deaths_province,
+         self.most_recovered_province, self.most_confirmed_country,
+         self.most_deaths_country, self.most_recovered_country) = leaders
+        (self.world_total_confirmed, self.world_total_deaths,
+         self.world_total_recovered) = self.summary.totals[-1]
+
+    def day(self, date):
+        """
+        Takes a date in any format pandas understands and returns the
+        position of the last date on or before it, or of the first date if
+        it comes before every date.
+        """
+        day = self.date_times.searchsorted(pd.Timestamp(date).normalize(),
+                                           side='right') - 1
+        return max(int(day), 0)
+
+    @cached_property
+    def today(self):
+        """
+        Dataframe of every location's counts on the latest date, followed
+        by a 'Total' row with the world totals.
+        """
+        today = fill_province(self.store.date_frame(self.dates[-1]))
+        total = dict(zip(self.store.metrics, self.summary.totals[-1]))
+        total.update({'Province/State': 'Total', 'Country/Region': 'Total',
+                      'date': self.dates[-1]})
+        return pd.concat([today, pd.DataFrame([total], index=['Total'])])
+
+    @cached_property
+    def today_by_Country(self):
+        """
+        Dataframe of every country's counts on the latest date.
+        """
+        return self.store_by_Country.date_frame(self.dates[-1])
+
+    def update(self, frames, version=None):
+        """
+        Takes a dictionary of wide dataframes holding newer versions of the
+        csv files and optionally the new version string. Returns a new
+        Dataset where only the new dates and corrected counts have been
+        processed. When the locations are the same as before, the derived
+        metrics, summary statistics, region totals and map levels of the
+        other dates are carried over from this Dataset rather than computed
+        again.
+        """
+        store, changed = update_store(self.store, frames)
+        store_by_Country = update_rollup(self.store_by_Country, store,
+                                         changed)
+        if not same_locations(self.store, store):
+            return Dataset(store, store_by_Country, version)
+        part = date_slice(store, changed)
+        n_dates = len(store.dates)
+        derived = {name: splice(self.derived[name], values, changed, n_dates)
+                   for name, values in compute_derived(part).items()}
+        spatial = None
+        if self.store.locations[['Lat', 'Long']].equals(
+                store.locations[['Lat', 'Long']]):
+            spatial = self.spatial.update(store, derived, changed)
+        part_regions = self.hierarchy.rollup(part)
+        regions = Store(part_regions.locations, store.dates,
+                        splice(self.regions.counts, part_regions.counts,
+                               changed, n_dates),
+                        LEVELS, store.metrics)
+        dataset = Dataset(store, store_by_Country, version,
+                          summary=self.summary.update(store, store_by_Country,
+                                                      changed),
+                          regions=regions, derived=derived, spatial=spatial)
+        dataset.hierarchy = self.hierarchy
+        return dataset
+
+    @cached_property
+    def date_times(self):
+        """
+        The dates as datetimes, so the day column of master can be turned
+        back into dates with date_times[master['day']].
+        """
+        return pd.to_datetime(self.dates, format='%m/%d/%y')
+
+    @cached_property
+    def derived(self):
+        """
+        Dictionary mapping each derived metric to its (locations, dates)
+        array.
+        """
+        return compute_derived(self.store)
+
+    @cached_property
+    def _master(self):
+        """
+        Builds master and its location index together.
+        """
+        return master_frame(self.store, self.derived)
+
+    @property
+    def master(self):
+        """
+        The long dataframe with one row per location and date.
+        """
+        return self._master[0]
+
+    @property
+    def master_index(self):
+        """
+        Dictionary mapping each location name to its slice of master rows.
+        """
+        return self._master[1]
+
+    @cached_property
+    def hierarchy(self):
+        """
+        The Hierarchy of countries, provinces or states, and counties that
+        the locations belong to.
+        """
+        return Hierarchy(self.store.locations)
+
+    @cached_property
+    def regions(self):
+        """
+        Store of the totals of every region in the hierarchy, in the same
+        order as hierarchy.nodes.
+        """
+        return self.hierarchy.rollup(self.store)
+
+    def region(self, key, day):
+        """
+        Takes the key of a region, such as 'US / Washington', or 'Total' for
+        the whole world, and the position of a date. Returns a dictionary
+        mapping each metric to the region's count on that date, which is 0
+        for unknown regions.
+        """
+        node = self.hierarchy.position(key)
+        if key == 'Total' or node < 0:
+            return self.summary.location(key, day)
+        return {metric: int(value) for metric, value in
+                zip(self.regions.metrics, self.regions.counts[node, day])}
+
+    @cached_property
+    def spatial(self):
+        """
+        The SpatialIndex of the map's levels of detail.
+        """
+        return SpatialIndex(self.store, self.derived)
+
+    @cached_property
+    def master_by_Country(self):
+        """
+        The long dataframe of country totals.
+        """
+        return self.store_by_Country.to_frame()
+
+    @cached_property
+    def grouped_date(self):
+        """
+        master grouped by date.
+        """
+        return self.master.groupby(['day'], as_index=False)
+
+
 # Setting url's for the three csv files used.
 url_confirmed = ('https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/archived_data/archived_time_series/time_series_19-covid-Confirmed_archived_0325.csv')
 
@@ -90,107 +1506,589 @@ url_deaths = ('https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/
 
 url_recovered = ('https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/archived_data/archived_time_series/time_series_19-covid-Recovered_archived_0325.csv')
 
-# Writing the data into local csv files.
-get_data(url_confirmed, 'covid19_confirmed.csv')
-get_data(url_deaths, 'covid19_deaths.csv')
-get_data(url_recovered, 'covid19_recovered.csv')
-
-# Initializing geopandas dataframes from csv files.
-confirmed = pd_0('covid19_confirmed.csv')
-deaths = pd_0('covid19_deaths.csv')
-recovered = pd_0('covid19_recovered.csv')
-
-# Removing US Counties counts
-confirmed = remove_us_counties(confirmed)
-deaths = remove_us_counties(deaths)
-recovered = remove_us_counties(recovered)
-
-# Branching to country totals
-confirmed_by_Country = confirmed.groupby(['Country/Region'],
-                                         as_index=False).sum()
-deaths_by_Country = deaths.groupby(['Country/Region'],
-                                   as_index=False).sum()
-recovered_by_Country = recovered.groupby(['Country/Region'],
-                                         as_index=False).sum()
-
-# Transforming geopandas dataframe from multiple to one date column.
-confirmed = melter(confirmed, 'Confirmed', ['Province/State', 'Country/Region',
-                                            'Lat', 'Long'])
-deaths = melter(deaths, 'Deaths', ['Province/State', 'Country/Region', 'Lat',
-                                   'Long'])
-recovered = melter(recovered, 'Recovered', ['Province/State', 'Country/Region',
-                                            'Lat', 'Long'])
-
-confirmed_by_Country = melter(confirmed_by_Country,
-                              'Confirmed', ['Country/Region', 'Lat', 'Long'])
-deaths_by_Country = melter(deaths_by_Country,
-                           'Deaths', ['Country/Region', 'Lat', 'Long'])
-recovered_by_Country = melter(recovered_by_Country,
-                              'Recovered', ['Country/Region', 'Lat', 'Long'])
-
-
-# Combining confirmed, deaths, and recovered data into one dataframe.
-cols_to_use = deaths.columns.difference(confirmed.columns)
-master = pd.merge(confirmed, deaths[cols_to_use],
-                  left_index=True, right_index=True, how='outer')
-cols_to_use = recovered.columns.difference(master.columns)
-master = pd.merge(master, recovered[cols_to_use],
-                  left_index=True, right_index=True, how='outer')
-
-conf_columns = confirmed_by_Country.columns
-cols_to_use = deaths_by_Country.columns.difference(conf_columns)
-master_by_Country = pd.merge(confirmed_by_Country,
-                             deaths_by_Country[cols_to_use],
-                             left_index=True, right_index=True, how='outer')
-master_columns = master_by_Country.columns
-cols_to_use = recovered_by_Country.columns.difference(master_columns)
-master_by_Country = pd.merge(master_by_Country,
-                             recovered_by_Country[cols_to_use],
-                             left_index=True, right_index=True, how='outer')
-
-master.loc[master['Province/State'].isnull(),
-           'Province/State'] = master['Country/Region']
-
-# Space for computing summary statistics from dataset
-dates = master['date'].unique()
-today = master[master['date'] == dates[-1]]
-
-grouped_date = master.groupby(['date'], as_index=False)
-
-most_confirmed_province = today.loc[today['Confirmed'].idxmax(),
-                                    'Province/State']
-most_deaths_province = today.loc[today['Deaths'].idxmax(),
-                                 'Province/State']
-most_recovered_province = today.loc[today['Recovered'].idxmax(),
-                                    'Province/State']
-
-today_by_Country = master_by_Country[master_by_Country['date'] == dates[-1]]
-confirmed_id = today_by_Country['Confirmed'].idxmax()
-most_confirmed_country = today_by_Country.loc[confirmed_id, 'Country/Region']
-deaths_id = today_by_Country['Deaths'].idxmax()
-most_deaths_country = today_by_Country.loc[deaths_id, 'Country/Region']
-recovered_id = today_by_Country['Recovered'].idxmax()
-most_recovered_country = today_by_Country.loc[recovered_id, 'Country/Region']
-
-world_total_confirmed = today['Confirmed'].sum()
-world_total_deaths = today['Deaths'].sum()
-world_total_recovered = today['Recovered'].sum()
-
-master['percent_deaths'] = master['Deaths'] / master['Confirmed']
-master['percent_recovered'] = master['Recovered'] / master['Confirmed']
-
-
-# Creating columns for graphical display use.
-master['Confirmed_Size'] = master.apply(lambda x: log_unless_0(x['Confirmed']),
-                                        axis=1)
-master['Deaths_Color'] = master.apply(lambda x: log_unless_0(x['Deaths']),
-                                      axis=1)
-
-# Converting dates in the dataframe to datetime objects
-master['date_time'] = pd.to_datetime(master['date'], format='%m/%d/%y')
-
-print(today)
-today.loc['Total', :] = today.sum()
-today.loc['Total', 'Province/State'] = 'Total'
-today.loc['Total', 'Country/Region'] = 'Total'
-print(today)
+# Folder holding the csv files and the snapshots built from them.
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+SNAPSHOT_DIR = os.path.join(DATA_DIR, 'snapshots')
+
+# Metric name, url, and local csv file for each source.
+SOURCES = [('Confirmed', url_confirmed,
+            os.path.join(DATA_DIR, 'covid19_confirmed.csv')),
+           ('Deaths', url_deaths,
+            os.path.join(DATA_DIR, 'covid19_deaths.csv')),
+           ('Recovered', url_recovered,
+            os.path.join(DATA_DIR, 'covid19_recovered.csv'))]
+
+# Changed whenever the processing changes, so old snapshots are not reused.
+SNAPSHOT_FORMAT = '11'
+
+# Names the columns of the daily report files have had over time, mapped to
+# the names used in the time series files, along with the names some
+# countries were once reported under.
+DAILY_COLUMNS = {'Province_State': 'Province/State',
+                 'Country_Region': 'Country/Region',
+                 'Latitude': 'Lat', 'Longitude': 'Long', 'Long_': 'Long',
+                 'Admin2': 'County'}
+COUNTRY_NAMES = {'Mainland China': 'China', 'South Korea': 'Korea, South',
+                 'Republic of Korea': 'Korea, South',
+                 'Iran (Islamic Republic of)': 'Iran', 'UK': 'United Kingdom',
+                 'Taiwan': 'Taiwan*', 'Viet Nam': 'Vietnam',
+                 'Russian Federation': 'Russia'}
+
+# Seconds a snapshot is kept after it was saved even if it is not the
+# newest, giving the process that saved it time to publish it.
+PRUNE_SECONDS = 60
+
+# Number of daily report files parsed and merged into the store at a time.
+DAILY_CHUNK = 32
+
+# Names the module used to define when it loaded the data on import, which
+# are now looked up on the current Dataset.
+LEGACY_NAMES = {'master', 'master_by_Country', 'dates', 'today',
+                'today_by_Country', 'grouped_date',
+                'most_confirmed_province', 'most_deaths_province',
+                'most_recovered_province', 'most_confirmed_country',
+                'most_deaths_country', 'most_recovered_country',
+                'world_total_confirmed', 'world_total_deaths',
+                'world_total_recovered'}
+
+# The Dataset returned by the most recent call to load or attach, the lock
+# held while replacing it, and the functions called with each new one.
+_current = None
+_lock = threading.RLock()
+_listeners = []
+
+
+def source_hash(file_names):
+    """
+    Takes a list of file names and returns a hash of their contents along
+    with the snapshot format.
+    """
+    digest = hashlib.sha1(SNAPSHOT_FORMAT.encode())
+    for file_name in file_names:
+        with open(file_name, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+@metrics.stage('read')
+def read_sources(sources):
+    """
+    Takes a list of (metric, url, file name) sources and returns a
+    dictionary mapping each metric to its csv file as a wide dataframe.
+    US counties are kept as locations of their own, and are only added into
+    their state's totals through the Hierarchy.
+    """
+    return {metric: pd_0(file_name) for metric, _, file_name in sources}
+
+
+def ingest(sources):
+    """
+    Takes a list of (metric, url, file name) sources and returns a Store
+    built from their csv files.
+    """
+    return build_store(read_sources(sources))
+
+
+def daily_files(folder):
+    """
+    Takes a folder of daily report files, named like 03-22-2020.csv, and
+    returns their paths in date order.
+    """
+    names = [name for name in os.listdir(folder)
+             if len(name) == 14 and name.endswith('.csv')]
+    dates = pd.to_datetime([name[:-4] for name in names], format='%m-%d-%Y',
+                           errors='coerce')
+    return [os.path.join(folder, names[i]) for i in np.argsort(dates)
+            if not pd.isna(dates[i])]
+
+
+def daily_date(file_name):
+    """
+    Takes the path of a daily report file and returns its date in the m/d/yy
+    format of the time series files.
+    """
+    day = pd.to_datetime(os.path.basename(file_name)[:-4], format='%m-%d-%Y')
+    return str(day.month) + '/' + str(day.day) + '/' + day.strftime('%y')
+
+
+def read_daily(file_name):
+    """
+    Takes the path of a daily report file and returns its date in the m/d/yy
+    format of the time series files, along with a dataframe holding the
+    ID_COLS and METRICS of every location in it. The differing column names
+    of older and newer files are renamed to one set. US counties are named
+    like the counties of the time series files, and the rows of other
+    locations that share a key, such as the districts of a province, are
+    summed together.
+    """
+    frame = pd.read_csv(file_name, encoding='utf-8-sig')
+    frame.columns = frame.columns.str.strip()
+    frame = frame.rename(columns=DAILY_COLUMNS)
+    for col in ID_COLS + METRICS + ['County']:
+        if col not in frame:
+            frame[col] = np.nan
+
+    country = frame['Country/Region'].astype(str).str.strip()
+    country = country.replace(COUNTRY_NAMES)
+    province = frame['Province/State'].astype(str).str.strip()
+    province = province.where(frame['Province/State'].notna(), '')
+    county = frame['County'].astype(str).str.strip()
+    code = province.map({state: code for code, state in STATE_CODES.items()})
+    is_county = (country == 'US') & frame['County'].notna() & code.notna()
+    province = province.where(~is_county, county + ', ' + code)
+
+    table = pd.DataFrame({'Province/State': province,
+                          'Country/Region': country})
+    table['Lat'] = frame['Lat'].astype(float)
+    table['Long'] = frame['Long'].astype(float)
+    for metric in METRICS:
+        table[metric] = pd.to_numeric(frame[metric], errors='coerce') \
+            .fillna(0).astype(np.int64)
+    table = table.groupby(KEY_COLS, sort=False, as_index=False).agg(
+        dict(Lat='first', Long='first',
+             **{metric: 'sum' for metric in METRICS}))
+    table['Province/State'] = table['Province/State'].where(
+        table['Province/State'] != '')
+    return daily_date(file_name), table[ID_COLS + METRICS]
+
+
+def daily_frames(reports):
+    """
+    Takes a list of (date, dataframe) pairs returned by read_daily, in date
+    order, and returns a dictionary mapping each metric to a wide dataframe
+    like the ones read from the time series files, holding 0 for locations
+    missing from a report.
+    """
+    # Taking each location's description from its latest report, since
+    # older reports have no coordinates.
+    locations = unique_locations([table[ID_COLS]
+                                  for _, table in reversed(reports)])
+    locations = locations.reset_index(drop=True)
+    index = location_keys(locations, KEY_COLS)
+    dates = [date for date, _ in reports]
+    values = np.zeros((len(METRICS), len(locations), len(dates)),
+                      dtype=np.int64)
+    for j, (_, table) in enumerate(reports):
+        rows = index.get_indexer(location_keys(table, KEY_COLS))
+        values[:, rows, j] = table[METRICS].to_numpy().T
+    return {metric: pd.concat([locations,
+                               pd.DataFrame(values[k], columns=dates)],
+                              axis=1)
+            for k, metric in enumerate(METRICS)}
+
+
+@metrics.stage('ingest_daily')
+def ingest_daily(file_names, store=None, processes=None, chunk=DAILY_CHUNK):
+    """
+    Takes a list of daily report files in date order, optionally the Store
+    to add them to, the number of worker processes to parse them with (the
+    number of CPUs if None), and how many files to hold in memory at a time.
+    Parses the files in a process pool a chunk at a time and merges each
+    chunk into the store with merge_store, so memory use does not grow
+    with the number of files. Returns the Store, or the given store if
+    there are no files.
+    """
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for start in range(0, len(file_names), chunk):
+            reports = list(pool.map(read_daily,
+                                    file_names[start:start + chunk]))
+            frames = daily_frames(reports)
+            if store is None:
+                store = build_store(frames)
+            else:
+                store = merge_store(store, frames)
+                fill_coordinates(store, frames['Confirmed'])
+    return store
+
+
+def fill_coordinates(store, locations):
+    """
+    Takes a Store and a location dataframe, and fills in the Lat and Long
+    of the store's locations that have none from the matching rows of the
+    dataframe.
+    """
+    missing = store.locations['Lat'].isna().to_numpy()
+    if not missing.any():
+        return
+    rows = location_keys(locations, KEY_COLS).get_indexer(
+        store.location_index[missing])
+    found = rows >= 0
+    positions = np.flatnonzero(missing)[found]
+    for col in ('Lat', 'Long'):
+        values = store.locations[col].to_numpy(dtype=float, copy=True)
+        values[positions] = locations[col].to_numpy(dtype=float)[rows[found]]
+        store.locations[col] = values
+
+
+def file_stamps(file_names):
+    """
+    Takes a list of file names and returns a dictionary mapping each base
+    name to its size and modification time, which change when it is
+    rewritten.
+    """
+    stamps = {}
+    for file_name in file_names:
+        stat = os.stat(file_name)
+        stamps[os.path.basename(file_name)] = [stat.st_size, stat.st_mtime_ns]
+    return stamps
+
+
+@metrics.stage('save_snapshot')
+def save_snapshot(dataset, path, files=None):
+    """
+    Takes a Dataset, the snapshot directory to write it to, and for data
+    read from daily reports the file_stamps of the files read. Along with
+    the stores, master and its location index, the derived metrics and the
+    levels of detail of the map are saved so that processes opening the
+    snapshot share them instead of building their own. The
+    snapshot is written next to its final location and renamed into place.
+    Older snapshots are left for prune_snapshots to remove once the new one
+    has been published.
+    """
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp = path + '.tmp' + str(os.getpid())
+    save_store(dataset.store, os.path.join(tmp, 'province'))
+    save_store(dataset.store_by_Country, os.path.join(tmp, 'country'))
+    save_frame(dataset.master, os.path.join(tmp, 'master'))
+    save_summary(dataset.summary, os.path.join(tmp, 'summary'))
+    save_store(dataset.regions, os.path.join(tmp, 'regions'))
+    save_arrays(dataset.derived, os.path.join(tmp, 'derived'))
+    save_spatial(dataset.spatial, os.path.join(tmp, 'spatial'))
+    with open(os.path.join(tmp, 'master_index.json'), 'w') as f:
+        json.dump({name: [int(rows.start), int(rows.stop)]
+                   for name, rows in dataset.master_index.items()}, f)
+    with open(os.path.join(tmp, 'snapshot.json'), 'w') as f:
+        json.dump(dict(format=SNAPSHOT_FORMAT, version=dataset.version,
+                       files=files, folder=dataset.folder), f)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # Another process wrote the same snapshot first.
+        shutil.rmtree(tmp)
+
+
+def prune_snapshots(path):
+    """
+    Takes the snapshot directory just published and removes the other
+    snapshots in its folder, except the newest one read from daily reports
+    and the newest one read from time series files, so switching between
+    the two does not throw away the other's work, and except the one the
+    current link points at, which may have been published by another
+    process since, and except any saved in the last PRUNE_SECONDS, which
+    another process may be about to publish. Processes still attached to a
+    removed snapshot keep reading its arrays, which stay on disk until they
+    are closed.
+    """
+    parent = os.path.dirname(path)
+    keep = {os.path.basename(path), 'current', published(parent)}
+    daily = snapshot_meta(path).get('files') is not None
+    kept_other = False
+    paths = [os.path.join(parent, name) for name in os.listdir(parent)
+             if name not in keep and '.tmp' not in name]
+    for other in sorted(paths, key=os.path.getmtime, reverse=True):
+        if time.time() - os.path.getmtime(other) < PRUNE_SECONDS:
+            continue
+        meta = snapshot_meta(other)
+        if not kept_other and meta is not None and \
+                (meta.get('files') is not None) != daily:
+            # The newest snapshot of the other kind.
+            kept_other = True
+            continue
+        shutil.rmtree(other, ignore_errors=True)
+
+
+def open_snapshot(path, version):
+    """
+    Takes a snapshot directory written by save_snapshot and its version, and
+    returns the memory-mapped Dataset stored there.
+    """
+    with open(os.path.join(path, 'master_index.json')) as f:
+        index = {name: slice(start, stop)
+                 for name, (start, stop) in json.load(f).items()}
+    with open(os.path.join(path, 'snapshot.json')) as f:
+        folder = json.load(f).get('folder')
+    store = open_store(os.path.join(path, 'province'))
+    store_by_Country = open_store(os.path.join(path, 'country'))
+    derived = open_arrays(os.path.join(path, 'derived'), DERIVED)
+    return Dataset(store, store_by_Country, version,
+                   (open_frame(os.path.join(path, 'master')), index),
+                   open_summary(os.path.join(path, 'summary'),
+                                store_by_Country),
+                   open_store(os.path.join(path, 'regions')), derived,
+                   folder,
+                   open_spatial(os.path.join(path, 'spatial'), store,
+                                derived))
+
+
+def publish(path):
+    """
+    Takes a snapshot directory and points the current link in its folder at
+    it. The link is replaced in a single rename, so processes following it
+    always see either the old snapshot or the new one.
+    """
+    link = os.path.join(os.path.dirname(path), 'current')
+    tmp = link + '.tmp' + str(os.getpid())
+    os.symlink(os.path.basename(path), tmp)
+    os.replace(tmp, link)
+
+
+def published(snapshot_dir=SNAPSHOT_DIR):
+    """
+    Takes the folder holding snapshots and returns the version the current
+    link points at, or None if nothing has been published.
+    """
+    try:
+        return os.readlink(os.path.join(snapshot_dir, 'current'))
+    except OSError:
+        return None
+
+
+def attach(snapshot_dir=SNAPSHOT_DIR):
+    """
+    Makes the published snapshot the current Dataset and returns it,
+    without looking at the csv files. Every process attached to the same
+    snapshot shares its memory-mapped arrays. Loads the data if nothing
+    usable has been published yet.
+    """
+    version = published(snapshot_dir)
+    path = os.path.join(snapshot_dir, str(version))
+    if version is None or snapshot_version(path) != version:
+        return load(snapshot_dir=snapshot_dir)
+    return swap(open_snapshot(path, version))
+
+
+def sync(snapshot_dir=SNAPSHOT_DIR):
+    """
+    Attaches to the published snapshot if it is newer than the current
+    Dataset. Cheap enough to call before every request.
+    """
+    version = published(snapshot_dir)
+    if version is not None and (_current is None or
+                                _current.version != version):
+        with _lock:
+            if _current is None or _current.version != version:
+                attach(snapshot_dir)
+
+
+def snapshot_meta(path):
+    """
+    Takes a snapshot directory and returns the dictionary saved with it,
+    holding its format, version and the daily report files it was read
+    from, or None if it is missing or was written in an older format.
+    """
+    try:
+        with open(os.path.join(path, 'snapshot.json')) as f:
+            meta = json.load(f)
+    except OSError:
+        return None
+    if meta['format'] != SNAPSHOT_FORMAT:
+        return None
+    return meta
+
+
+def snapshot_version(path):
+    """
+    Takes a snapshot directory and returns its version, or None if it is
+    missing or was written in an older format.
+    """
+    meta = snapshot_meta(path)
+    return None if meta is None else meta['version']
+
+
+def latest_snapshot(snapshot_dir, daily=False):
+    """
+    Takes the folder holding snapshots and whether to look for one read
+    from daily reports rather than time series files. Returns the most
+    recently written such snapshot in the current format as a Dataset,
+    along with the daily report files it was read from, or (None, None) if
+    there is none.
+    """
+    if not os.path.isdir(snapshot_dir):
+        return None, None
+    paths = [os.path.join(snapshot_dir, name)
+             for name in os.listdir(snapshot_dir)
+             if name != 'current' and '.tmp' not in name]
+    for path in sorted(paths, key=os.path.getmtime, reverse=True):
+        meta = snapshot_meta(path)
+        if meta is not None and (meta.get('files') is not None) == daily:
+            return open_snapshot(path, meta['version']), meta.get('files')
+    return None, None
+
+
+def load(download=False, sources=SOURCES, snapshot_dir=SNAPSHOT_DIR):
+    """
+    Loads the data and returns it as the current Dataset. Downloads the csv
+    files first if download is True or if any of them are missing. When a
+    snapshot built from csv files with the same contents exists it is
+    memory-mapped and the csv files are not parsed. Otherwise the csv files
+    are read and, if an older snapshot exists, only their new dates and
+    corrected counts are processed on top of it, before the result is saved
+    as a new snapshot. The snapshot is then published for other processes
+    to attach to.
+    """
+    file_names = [file_name for _, _, file_name in sources]
+    if download or not all(os.path.exists(f) for f in file_names):
+        fetch_all(sources)
+
+    version = source_hash(file_names)
+    path = os.path.join(snapshot_dir, version)
+    if os.path.isdir(path):
+        dataset = open_snapshot(path, version)
+    else:
+        frames = read_sources(sources)
+        previous, _ = latest_snapshot(snapshot_dir)
+        if previous is None:
+            dataset = Dataset(build_store(frames), version=version)
+        else:
+            dataset = previous.update(frames, version)
+        save_snapshot(dataset, path)
+    publish(path)
+    prune_snapshots(path)
+    return swap(dataset)
+
+
+def daily_version(stamps):
+    """
+    Takes the file_stamps of a folder of daily report files and returns the
+    version of the data read from them.
+    """
+    digest = hashlib.sha1(SNAPSHOT_FORMAT.encode())
+    digest.update(json.dumps(stamps, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+
+def load_daily(folder, snapshot_dir=SNAPSHOT_DIR, processes=None):
+    """
+    Loads a folder of daily report files and returns it as the current
+    Dataset, in place of the time series files. When the files have not
+    changed since the last call the snapshot built from them is
+    memory-mapped. Otherwise only the files that are new or were rewritten
+    since the latest daily snapshot are parsed, with ingest_daily, and
+    merged into it before it is saved and published as a new snapshot.
+    Every file is parsed again if a new file falls before the latest date
+    already read.
+    """
+    file_names = daily_files(folder)
+    stamps = file_stamps(file_names)
+    version = daily_version(stamps)
+    path = os.path.join(snapshot_dir, version)
+    if os.path.isdir(path):
+        dataset = open_snapshot(path, version)
+    else:
+        previous, seen = latest_snapshot(snapshot_dir, daily=True)
+        seen = seen or {}
+        new = [file_name for file_name in file_names
+               if seen.get(os.path.basename(file_name)) !=
+               stamps[os.path.basename(file_name)]]
+        if previous is not None:
+            last = pd.to_datetime(previous.dates[-1], format='%m/%d/%y')
+            if any(date not in previous.store.date_index and
+                   pd.to_datetime(date, format='%m/%d/%y') < last
+                   for date in map(daily_date, new)):
+                previous, new = None, file_names
+        store = ingest_daily(new, None if previous is None else previous.store,
+                             processes)
+        if store is None:
+            raise ValueError('No daily report files in ' + folder)
+        dataset = Dataset(store, version=version,
+                          folder=os.path.abspath(folder))
+        save_snapshot(dataset, path, stamps)
+    publish(path)
+    prune_snapshots(path)
+    return swap(dataset)
+
+
+def swap(dataset):
+    """
+    Takes a fully built Dataset and makes it the current one in a single
+    assignment, then calls every function passed to subscribe with it.
+    Callbacks that looked up the old Dataset before the swap keep using it
+    until they finish. Returns the Dataset.
+    """
+    global _current
+    with _lock:
+        changed = _current is None or _current.version != dataset.version
+        _current = dataset
+        if changed:
+            for listener in _listeners:
+                listener(dataset)
+    return dataset
+
+
+def subscribe(listener):
+    """
+    Takes a function of one argument to call with each new current Dataset,
+    for example to drop figures cached for older versions.
+    """
+    _listeners.append(listener)
+
+
+@metrics.stage('refresh')
+def refresh(sources=SOURCES, snapshot_dir=SNAPSHOT_DIR, folder=None):
+    """
+    Brings the current Dataset up to date and returns it. Data read from a
+    folder of daily report files, either the given folder or the one the
+    current Dataset was read from, is loaded again with load_daily if any
+    file in the folder was added or changed. Otherwise the csv files are
+    downloaded, and if any of them changed (or the current Dataset was
+    built from other files) the new data is loaded next to the current
+    Dataset and swapped in.
+    """
+    if folder is None and _current is not None:
+        folder = _current.folder
+    if folder is not None:
+        version = daily_version(file_stamps(daily_files(folder)))
+        if _current is None or _current.version != version:
+            return load_daily(folder, snapshot_dir)
+        return _current
+    changed = fetch_all(sources)
+    version = source_hash([file_name for _, _, file_name in sources])
+    if changed or _current is None or _current.version != version:
+        return load(sources=sources, snapshot_dir=snapshot_dir)
+    return _current
+
+
+def current():
+    """
+    Returns the current Dataset, attaching to the published snapshot first
+    if nothing has been loaded.
+    """
+    if _current is None:
+        with _lock:
+            if _current is None:
+                return attach()
+    return _current
+
+
+def __getattr__(name):
+    """
+    Looks up the names this module used to define, such as master or today,
+    on the current Dataset, so they can still be read from the module
+    itself. Any other name raises AttributeError without loading anything.
+    """
+    if name not in LEGACY_NAMES:
+        raise AttributeError('module ' + repr(__name__) +
+                             ' has no attribute ' + repr(name))
+    return getattr(current(), name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--no-download', dest='download',
+                        action='store_false',
+                        help='use the csv files already on disk')
+    parser.add_argument('--daily', metavar='FOLDER',
+                        help='read a folder of daily report files instead '
+                        'of the time series files')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='compare the memory used by master in its '
+                        'compact and old layouts')
+    args = parser.parse_args()
+    if args.daily:
+        dataset = load_daily(args.daily)
+    else:
+        dataset = load(download=args.download)
+    print(dataset.today)
+    if args.memory_report:
+        print(memory_report(dataset))
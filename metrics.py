@@ -0,0 +1,382 @@
+"""
+Keeps lightweight timing metrics for the data pipeline stages and the
+dashboard callbacks, and serves them in the Prometheus text format.
+
+Each timed stage or callback records its latency in a histogram along with
+how many times it ran and failed. Pipeline stages also record the size of
+their result, and dashboard responses record their size in bytes. Recording
+only takes a clock read and a few additions under a lock, so it can be left
+on in production.
+
+When the dashboard runs in several processes, as under serve.py, each
+process calls registry.share with the same folder and writes its metrics
+there every few seconds. The metrics page then adds up the histograms and
+counters of every process that has written to the folder, including ones
+that have since exited, so totals never go backwards whichever worker
+answers. Gauges describe a single process, so they are shown for each live
+process with a pid label instead of being added up. Other processes'
+metrics can be up to SHARE_SECONDS old.
+"""
+from bisect import bisect_left
+from functools import wraps
+import atexit
+import json
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+# Upper bounds of the size histogram buckets, in bytes.
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+
+# Seconds between writes of a process's metrics to the shared folder.
+SHARE_SECONDS = 5
+
+
+class Histogram:
+    """
+    Counts observations in fixed buckets, keeping their total, in the shape
+    Prometheus expects.
+    """
+    def __init__(self, buckets):
+        """
+        Takes the upper bounds of the buckets in increasing order.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        Takes a value and adds it to its bucket.
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def add(self, counts, total):
+        """
+        Takes the bucket counts and total of another histogram with the
+        same buckets and adds them to this one.
+        """
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.sum += total
+
+    def lines(self, name, labels):
+        """
+        Takes the metric name and a label string such as 'stage="read"' and
+        returns the Prometheus text lines for the histogram.
+        """
+        lines = []
+        total = 0
+        bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            lines.append(name + '_bucket{' + labels + ',le="' + bound +
+                         '"} ' + str(total))
+        lines.append(name + '_sum{' + labels + '} ' + repr(self.sum))
+        lines.append(name + '_count{' + labels + '} ' + str(total))
+        return lines
+
+
+class Registry:
+    """
+    Holds every recorded metric, keyed by metric name and label string.
+    """
+    def __init__(self):
+        """
+        Creates an empty registry.
+        """
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._help = {}
+        self._collectors = []
+        self._folder = None
+
+    def describe(self, name, kind, text):
+        """
+        Takes a metric name, its Prometheus type and a help text.
+        """
+        self._help[name] = (kind, text)
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        """
+        Adds a value to the histogram with the given name and labels.
+        """
+        with self._lock:
+            key = (name, labels)
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(buckets)
+            self._histograms[key].observe(value)
+
+    def inc(self, name, labels, amount=1):
+        """
+        Adds an amount to the counter with the given name and labels.
+        """
+        with self._lock:
+            key = (name, labels)
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set(self, name, labels, value):
+        """
+        Sets the gauge with the given name and labels.
+        """
+        with self._lock:
+            self._gauges[(name, labels)] = value
+
+    def add_collector(self, collect):
+        """
+        Takes a function of no arguments that is called just before the
+        metrics are exported, to set gauges from state kept elsewhere.
+        """
+        self._collectors.append(collect)
+
+    def share(self, folder, interval=SHARE_SECONDS):
+        """
+        Takes a folder shared by every process serving the dashboard and
+        the seconds between writes. Starts writing this process's metrics
+        to the folder, and exporting the metrics of every process that
+        writes there. Anything recorded before is dropped, since in a
+        forked worker it was recorded by the parent, which reports it.
+        """
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._gauges.clear()
+        self._folder = folder
+
+        def write_every_interval():
+            while True:
+                time.sleep(interval)
+                self.write()
+
+        threading.Thread(target=write_every_interval, daemon=True).start()
+        atexit.register(self.write)
+
+    def write(self):
+        """
+        Writes this process's metrics to the shared folder, replacing its
+        file in a single rename so readers never see half of it.
+        """
+        name = os.path.join(self._folder, str(os.getpid()) + '.json')
+        try:
+            with open(name + '.tmp', 'w') as f:
+                json.dump(self.state(), f)
+            os.replace(name + '.tmp', name)
+        except OSError:
+            # The folder is removed when the server shuts down.
+            pass
+
+    def state(self):
+        """
+        Returns this process's metrics as a json-ready dictionary, after
+        calling the collectors.
+        """
+        for collect in self._collectors:
+            collect()
+        with self._lock:
+            return dict(
+                pid=os.getpid(),
+                histograms=[[name, labels, hist.buckets, hist.counts,
+                             hist.sum]
+                            for (name, labels), hist in
+                            self._histograms.items()],
+                counters=[[name, labels, value] for (name, labels), value
+                          in self._counters.items()],
+                gauges=[[name, labels, value] for (name, labels), value
+                        in self._gauges.items()])
+
+    def shared_states(self):
+        """
+        Returns the metrics of every other process that has written to the
+        shared folder, as dictionaries from state.
+        """
+        states = []
+        for name in os.listdir(self._folder):
+            if name.endswith('.json') and \
+                    name != str(os.getpid()) + '.json':
+                try:
+                    with open(os.path.join(self._folder, name)) as f:
+                        states.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return states
+
+    def export(self):
+        """
+        Returns every metric in the Prometheus text format, combined across
+        processes when the registry is shared.
+        """
+        states = [self.state()]
+        if self._folder is not None:
+            states += self.shared_states()
+        histograms = {}
+        counters = {}
+        gauges = {}
+        for state in states:
+            for name, labels, buckets, counts, total in state['histograms']:
+                key = (name, labels)
+                if key not in histograms:
+                    histograms[key] = Histogram(tuple(buckets))
+                histograms[key].add(counts, total)
+            for name, labels, value in state['counters']:
+                counters[(name, labels)] = \
+                    counters.get((name, labels), 0) + value
+            if self._folder is not None and not alive(state['pid']):
+                continue
+            for name, labels, value in state['gauges']:
+                if self._folder is not None:
+                    labels = ','.join(filter(None, [labels, label(
+                        'pid', state['pid'])]))
+                gauges[(name, labels)] = value
+
+        samples = {}
+        for (name, labels), hist in histograms.items():
+            samples.setdefault(name, []).extend(hist.lines(name, labels))
+        for values in (counters, gauges):
+            for (name, labels), value in values.items():
+                if labels:
+                    labels = '{' + labels + '}'
+                samples.setdefault(name, []).append(
+                    name + labels + ' ' + repr(value))
+        lines = []
+        for name in sorted(samples):
+            if name in self._help:
+                kind, text = self._help[name]
+                lines.append('# HELP ' + name + ' ' + text)
+                lines.append('# TYPE ' + name + ' ' + kind)
+            lines.extend(samples[name])
+        return '\n'.join(lines) + '\n'
+
+
+def alive(pid):
+    """
+    Takes a process id and returns whether that process is still running.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Registry used by the rest of the project.
+registry = Registry()
+registry.describe('covid_stage_seconds', 'histogram',
+                  'Time spent in each data pipeline stage.')
+registry.describe('covid_stage_result_bytes', 'gauge',
+                  'Size of the last result of each data pipeline stage.')
+registry.describe('covid_callback_seconds', 'histogram',
+                  'Time spent in each dashboard callback.')
+registry.describe('covid_errors_total', 'counter',
+                  'Stages and callbacks that raised an exception.')
+registry.describe('covid_response_bytes', 'histogram',
+                  'Size of dashboard callback responses.')
+
+
+def label(name, value):
+    """
+    Takes a label name and value and returns them as a label string.
+    """
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return name + '="' + value.replace('\n', '\\n') + '"'
+
+
+def nbytes(value):
+    """
+    Takes a pipeline result and returns roughly how many bytes its arrays
+    take up, looking inside tuples, lists, dictionaries, Stores and
+    Datasets.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(index=False)))
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+    if hasattr(value, 'counts') and hasattr(value, 'locations'):
+        return nbytes(value.counts) + nbytes(value.locations)
+    if hasattr(value, 'store') and hasattr(value, 'store_by_Country'):
+        return nbytes(value.store) + nbytes(value.store_by_Country)
+    return 0
+
+
+def stage(name):
+    """
+    Decorator that records the latency, failures and result size of a data
+    pipeline stage under the given name.
+    """
+    labels = label('stage', name)
+
+    def decorate(function):
+        @wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                registry.inc('covid_errors_total', labels)
+                raise
+            registry.observe('covid_stage_seconds', labels,
+                             time.perf_counter() - start)
+            if result is not None:
+                registry.set('covid_stage_result_bytes', labels,
+                             nbytes(result))
+            return result
+        return timed
+    return decorate
+
+
+def callback(function):
+    """
+    Decorator that records the latency and failures of a dashboard callback
+    under its function name.
+    """
+    labels = label('callback', function.__name__)
+
+    @wraps(function)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            registry.inc('covid_errors_total', labels)
+            raise
+        finally:
+            registry.observe('covid_callback_seconds', labels,
+                             time.perf_counter() - start)
+    return timed
+
+
+def serve(server, path='/metrics'):
+    """
+    Takes the Flask server of a Dash app and adds a route at path serving
+    the metrics, along with a hook recording the size of every callback
+    response by the component it updates.
+    """
+    import flask
+
+    @server.after_request
+    def record_response(response):
+        if flask.request.path.endswith('_dash-update-component'):
+            body = flask.request.get_json(silent=True) or {}
+            registry.observe('covid_response_bytes',
+                             label('output', body.get('output', '')),
+                             response.calculate_content_length() or 0,
+                             SIZE_BUCKETS)
+        return response
+
+    @server.route(path)
+    def metrics_page():
+        return flask.Response(registry.export(),
+                              mimetype='text/plain; version=0.0.4')
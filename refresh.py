@@ -0,0 +1,88 @@
+"""
+Keeps the dashboard's data up to date by downloading the csv files again on
+a fixed interval in a background thread, or by reading a folder of daily
+report files again when files are added to it.
+
+Each new version is built next to the one being served and only swapped in
+once it is complete, so requests never wait on a download or see half
+processed data. Callbacks already running finish with the version they
+started with.
+
+Example:
+    python refresh.py --interval 3600
+    python refresh.py --interval 600 --daily csse_covid_19_daily_reports
+"""
+import argparse
+import sys
+import threading
+import traceback
+import data
+
+
+class Refresher(threading.Thread):
+    """
+    A daemon thread that calls data.refresh every interval seconds until it
+    is stopped.
+    """
+    def __init__(self, interval, sources=data.SOURCES,
+                 snapshot_dir=data.SNAPSHOT_DIR, folder=None):
+        """
+        Takes the number of seconds between refreshes, and the sources,
+        snapshot folder and folder of daily report files to pass on to
+        data.refresh.
+        """
+        super().__init__(name='refresh', daemon=True)
+        self.interval = interval
+        self.sources = sources
+        self.snapshot_dir = snapshot_dir
+        self.folder = folder
+        self._stopped = threading.Event()
+
+    def run(self):
+        """
+        Refreshes the data every interval seconds. A failed refresh is
+        printed, counted in the metrics by data.refresh, and leaves the
+        current data in place until the next one.
+        """
+        while not self._stopped.wait(self.interval):
+            try:
+                data.refresh(self.sources, self.snapshot_dir, self.folder)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+    def stop(self):
+        """
+        Asks the thread to stop before its next refresh.
+        """
+        self._stopped.set()
+
+
+def main():
+    """
+    Refreshes the published snapshot on the interval given on the command
+    line, so that running dashboards pick up the new data.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('--interval', type=float, default=3600,
+                        help='seconds between downloads')
+    parser.add_argument('--daily', metavar='FOLDER',
+                        help='read this folder of daily report files '
+                             'instead of the time series files')
+    args = parser.parse_args()
+
+    if args.daily:
+        data.load_daily(args.daily)
+    else:
+        data.load()
+    refresher = Refresher(args.interval, folder=args.daily)
+    refresher.start()
+    try:
+        refresher.join()
+    except KeyboardInterrupt:
+        refresher.stop()
+
+
+if __name__ == '__main__':
+    main()
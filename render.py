@@ -0,0 +1,139 @@
+"""
+Renders the animated map from animation.py to one PNG image per date, using
+a pool of worker processes, and optionally joins the images into a video.
+
+Frames are named frame_0000.png, frame_0001.png, ... in date order. Frames
+that already exist are skipped, so running the command again after a
+failure only renders the missing frames. Writing images needs the kaleido
+package, and making a video needs ffmpeg on the PATH.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import shutil
+import subprocess
+import sys
+import animation
+import data
+import plotly.graph_objects as go
+
+# Dataset attached once in each worker process.
+_dataset = None
+
+
+def frame_name(i):
+    """
+    Takes the position of a date and returns the file name of its frame.
+    """
+    return 'frame_%04d.png' % i
+
+
+def frame_figure(dataset, i):
+    """
+    Takes a Dataset and the position of a date, and returns the map for that
+    date as a still figure. The color scale is fixed to the range over all
+    dates so frames can be compared with each other.
+    """
+    fig = go.Figure(animation.map_trace(dataset, i))
+    layer = animation.map_layer(dataset)
+    fig.update_traces(marker_cmin=0,
+                      marker_cmax=float(layer.derived['Deaths_Color'].max()))
+    fig.update_geos(showcountries=True, projection_type='natural earth')
+    fig.update_layout(title='Date: ' + dataset.dates[i])
+    return fig
+
+
+def init_worker():
+    """
+    Attaches a worker process to the published snapshot, which main loaded
+    and published before starting the workers, without hashing the csv
+    files or publishing anything again.
+    """
+    global _dataset
+    _dataset = data.attach()
+
+
+def render_frame(task):
+    """
+    Takes a tuple of the position of a date, the output folder, and the image
+    width and height. Writes the frame for that date and returns None, or
+    returns the error message if it could not be written.
+    """
+    i, out_dir, width, height = task
+    file_name = os.path.join(out_dir, frame_name(i))
+    tmp = os.path.join(out_dir, '.tmp_' + frame_name(i))
+    try:
+        frame_figure(_dataset, i).write_image(tmp, format='png',
+                                              width=width, height=height)
+        os.replace(tmp, file_name)
+    except Exception as e:
+        return str(e)
+    return None
+
+
+def render_frames(out_dir, workers=None, width=1200, height=700):
+    """
+    Takes an output folder, the number of worker processes (the number of
+    CPUs if None) and the image size. Renders every frame that does not
+    exist yet and returns a dictionary mapping the position of each frame
+    that failed to its error message. The data must already be loaded.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    n_dates = len(data.current().dates)
+    todo = [i for i in range(n_dates)
+            if not os.path.exists(os.path.join(out_dir, frame_name(i)))]
+    tasks = [(i, out_dir, width, height) for i in todo]
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=init_worker) as pool:
+        errors = pool.map(render_frame, tasks)
+        return {i: error for i, error in zip(todo, errors)
+                if error is not None}
+
+
+def make_video(out_dir, video, fps=5):
+    """
+    Takes the folder holding the frames, the video file name (the format
+    follows its extension, such as .mp4 or .gif) and the frames per second,
+    and joins the frames into the video with ffmpeg.
+    """
+    if shutil.which('ffmpeg') is None:
+        raise RuntimeError('ffmpeg is needed to make a video')
+    command = ['ffmpeg', '-y', '-framerate', str(fps),
+               '-i', os.path.join(out_dir, 'frame_%04d.png')]
+    if not video.endswith('.gif'):
+        command += ['-pix_fmt', 'yuv420p',
+                    '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2']
+    subprocess.run(command + [video], check=True)
+
+
+def main():
+    """
+    Renders the frames and the video given on the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('out_dir', help='folder to write the frames to')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('--width', type=int, default=1200)
+    parser.add_argument('--height', type=int, default=700)
+    parser.add_argument('--video', help='also join the frames into this '
+                        'video file (.mp4 or .gif)')
+    parser.add_argument('--fps', type=int, default=5)
+    args = parser.parse_args()
+
+    # Loading and publishing the snapshot once, for the workers to attach
+    # to.
+    data.load()
+    errors = render_frames(args.out_dir, args.workers, args.width,
+                           args.height)
+    for i, error in sorted(errors.items()):
+        print('Frame ' + str(i) + ' failed: ' + error, file=sys.stderr)
+    if errors:
+        sys.exit('Run again to retry the ' + str(len(errors)) +
+                 ' failed frames.')
+    if args.video:
+        make_video(args.out_dir, args.video, args.fps)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Runs the dashboard in production with several worker processes, using the
+gunicorn package.
+
+The parent process loads the data once and publishes it as a snapshot of
+memory-mapped arrays. Each worker attaches to the published snapshot instead
+of processing the csv files, so its data is shared with every other worker
+through the operating system's page cache and memory per worker stays flat
+as workers are added. Before each request a worker checks whether a newer
+snapshot has been published (for example by running data.py) and switches
+to it if so. The parent and the workers share their metrics through a
+temporary folder, so /metrics reports totals for the whole server whichever
+worker answers.
+
+Example:
+    python serve.py --workers 4 --bind 0.0.0.0:8050 --refresh 3600
+"""
+import argparse
+import atexit
+import os
+import shutil
+import tempfile
+import data
+from gunicorn.app.base import BaseApplication
+import metrics
+from refresh import Refresher
+
+
+class DashboardServer(BaseApplication):
+    """
+    A gunicorn application serving the dashboard from app.py.
+    """
+    def __init__(self, options, metrics_folder):
+        """
+        Takes a dictionary of gunicorn settings and the folder the workers
+        share their metrics through.
+        """
+        self.options = options
+        self.metrics_folder = metrics_folder
+        super().__init__()
+
+    def load_config(self):
+        """
+        Copies the settings into gunicorn's configuration.
+        """
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        """
+        Imports the dashboard in a worker and returns its Flask server.
+        """
+        metrics.registry.share(self.metrics_folder)
+        data.attach()
+        import app
+        app.server.before_request(data.sync)
+        return app.server
+
+
+def remove_folder(folder, pid):
+    """
+    Takes a folder and the process id of the parent process, and removes the
+    folder when called in that process. Workers inherit the parent's exit
+    handlers when they are forked, and must leave the folder in place.
+    """
+    if os.getpid() == pid:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def main():
+    """
+    Loads and publishes the data, then starts the workers.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--bind', default='127.0.0.1:8050')
+    parser.add_argument('--download', action='store_true',
+                        help='download the latest csv files first')
+    parser.add_argument('--daily', metavar='FOLDER',
+                        help='read this folder of daily report files '
+                             'instead of the time series files')
+    parser.add_argument('--refresh', type=float, metavar='SECONDS',
+                        help='download new data on this interval')
+    args = parser.parse_args()
+
+    metrics_folder = tempfile.mkdtemp(prefix='covid-metrics-')
+    atexit.register(remove_folder, metrics_folder, os.getpid())
+    metrics.registry.share(metrics_folder)
+    if args.daily:
+        data.load_daily(args.daily)
+    else:
+        data.load(download=args.download)
+    if args.refresh:
+        # Refreshing in the parent process, which publishes each new
+        # snapshot for the workers to switch to on their next request.
+        Refresher(args.refresh, folder=args.daily).start()
+    DashboardServer(dict(workers=args.workers, threads=args.threads,
+                         bind=args.bind, preload_app=False),
+                    metrics_folder).run()
+
+
+if __name__ == '__main__':
+    main()
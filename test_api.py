@@ -0,0 +1,101 @@
+"""
+Tests the json routes of api.py through Flask's test client.
+"""
+import gzip
+import json
+import flask
+import pytest
+import api
+import data
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    """
+    The Dataset built from the csv files in the repository.
+    """
+    return data.Dataset(data.build_store(data.read_sources(data.SOURCES)))
+
+
+@pytest.fixture
+def client(dataset, monkeypatch):
+    """
+    A test client for a Flask server with the json routes, serving the
+    dataset fixture as the current Dataset.
+    """
+    monkeypatch.setattr(data, '_current', dataset)
+    api.api_cache.clear()
+    server = flask.Flask(__name__)
+    api.serve(server)
+    return server.test_client()
+
+
+def test_series_records(client, dataset):
+    """
+    A GET returns one record per location and date with the counts asked
+    for.
+    """
+    response = client.get('/api/series?location=US&location=Italy'
+                          '&metric=Confirmed&start=2020-03-01')
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['version'] == dataset.version
+    last = body['records'][-1]
+    assert last['location'] == 'Italy'
+    assert last['Confirmed'] == dataset.region('Italy', -1)['Confirmed']
+    assert set(last) == {'location', 'date', 'Confirmed'}
+
+
+def test_series_revalidates_with_etag(client):
+    """
+    Asking again with the ETag of the last response is answered 304 with
+    no body.
+    """
+    url = '/api/series?location=US&shape=columns'
+    etag = client.get(url).headers['ETag']
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert client.get(url, headers={'If-None-Match': '"other"'}) \
+        .status_code == 200
+
+
+def test_series_gzip(client):
+    """
+    Clients that accept gzip get a gzipped body holding the same json.
+    """
+    url = '/api/series?location=US&location=China'
+    plain = client.get(url)
+    zipped = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in zipped.headers['Vary']
+    assert json.loads(gzip.decompress(zipped.data)) == plain.get_json()
+    assert zipped.headers['ETag'] != plain.headers['ETag']
+
+
+@pytest.mark.parametrize('request_args', [
+    dict(path='/api/series?location=US&shape=rows'),
+    dict(path='/api/series?location=Atlantis'),
+    dict(path='/api/series?location=US&start=someday'),
+    dict(path='/api/series', method='POST', json={'location': 5}),
+    dict(path='/api/series', method='POST',
+         json={'location': 'US', 'metric': ['Confirmed', 1]}),
+    dict(path='/api/series', method='POST', json=['US']),
+])
+def test_series_bad_queries(client, request_args):
+    """
+    Queries with an unknown shape, location or date, or fields of the wrong
+    type, are answered 400 with an error message.
+    """
+    response = client.open(**request_args)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_locations(client, dataset):
+    """
+    The locations route lists every region key.
+    """
+    body = client.get('/api/locations').get_json()
+    assert body['locations'] == list(dataset.hierarchy.keys)
+    assert 'US / Washington' in body['locations']
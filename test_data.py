@@ -0,0 +1,314 @@
+"""
+Tests downloading the csv files with get_data and fetch_all against a
+local web server, and updating a Dataset with newer csv files.
+"""
+import functools
+import http.server
+import json
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+import pytest
+import data
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves files from a folder without logging every request.
+    """
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    """
+    Serves a folder holding one csv file over http in a background thread,
+    and yields the folder along with the url of the file.
+    """
+    folder = tmp_path / 'remote'
+    folder.mkdir()
+    (folder / 'counts.csv').write_text('Country/Region,1/22/20\nItaly,1\n')
+    handler = functools.partial(QuietHandler, directory=str(folder))
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield folder, 'http://127.0.0.1:%d/counts.csv' % httpd.server_port
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_get_data_only_downloads_changed_files(server, tmp_path):
+    """
+    The first download and a download after the file changed return True,
+    and a download of an unchanged file is answered 304 and returns False.
+    """
+    folder, url = server
+    file_name = str(tmp_path / 'counts.csv')
+    assert data.get_data(url, file_name)
+    with open(file_name) as f:
+        assert f.read() == 'Country/Region,1/22/20\nItaly,1\n'
+
+    assert not data.get_data(url, file_name)
+
+    remote = folder / 'counts.csv'
+    remote.write_text('Country/Region,1/22/20\nItaly,2\n')
+    # Last-Modified has a resolution of one second, so the change is dated
+    # a minute later rather than relying on the clock moving on.
+    mtime = remote.stat().st_mtime + 60
+    os.utime(remote, (mtime, mtime))
+    assert data.get_data(url, file_name)
+    with open(file_name) as f:
+        assert f.read() == 'Country/Region,1/22/20\nItaly,2\n'
+
+
+def test_get_data_replaces_file_atomically(server, tmp_path):
+    """
+    A download is written to a new file that is renamed over the old one,
+    leaving no temporary files behind.
+    """
+    folder, url = server
+    file_name = str(tmp_path / 'counts.csv')
+    with open(file_name, 'w') as f:
+        f.write('old')
+    before = os.stat(file_name).st_ino
+    assert data.get_data(url, file_name)
+    assert os.stat(file_name).st_ino != before
+    assert sorted(os.listdir(tmp_path)) == ['counts.csv', 'counts.csv.meta',
+                                            'remote']
+
+
+def test_fetch_all(server, tmp_path):
+    """
+    fetch_all reports whether any file changed, and does nothing when there
+    are no sources.
+    """
+    folder, url = server
+    sources = [('Confirmed', url, str(tmp_path / 'confirmed.csv')),
+               ('Deaths', url, str(tmp_path / 'deaths.csv'))]
+    assert data.fetch_all(sources)
+    assert not data.fetch_all(sources)
+    assert not data.fetch_all([])
+
+
+def wide_frames(n_dates=6, seed=0):
+    """
+    Returns a small dictionary of wide dataframes in the layout of the time
+    series files, with a few countries, provinces and US counties.
+    """
+    rng = np.random.default_rng(seed)
+    locations = pd.DataFrame({
+        'Province/State': [np.nan, 'Hubei', 'Beijing', 'Washington',
+                           'King County, WA', np.nan, np.nan],
+        'Country/Region': ['Thailand', 'China', 'China', 'US', 'US',
+                           'Italy', 'Japan'],
+        'Lat': [15.0, 30.9, 40.2, 47.4, 47.5, 43.0, 36.0],
+        'Long': [101.0, 112.3, 116.4, -121.5, -121.8, 12.0, 138.0]})
+    dates = [(pd.Timestamp('2020-01-22') + pd.Timedelta(days=i))
+             .strftime('%-m/%-d/%y') for i in range(n_dates)]
+    frames = {}
+    for metric in data.METRICS:
+        counts = np.cumsum(rng.integers(0, 50, (len(locations), n_dates)),
+                           axis=1)
+        frames[metric] = pd.concat(
+            [locations, pd.DataFrame(counts, columns=dates)], axis=1)
+    return frames
+
+
+def assert_same_dataset(updated, built):
+    """
+    Checks that a Dataset returned by update holds the same data as one
+    built from scratch from the same files.
+    """
+    pd.testing.assert_frame_equal(updated.store.locations,
+                                  built.store.locations)
+    assert updated.store.dates == built.store.dates
+    assert np.array_equal(updated.store.counts, built.store.counts)
+    assert np.array_equal(updated.store_by_Country.counts,
+                          built.store_by_Country.counts)
+    for name in built.derived:
+        assert np.array_equal(updated.derived[name], built.derived[name])
+    for name in ('totals', 'top_names', 'top_countries'):
+        assert np.array_equal(getattr(updated.summary, name),
+                              getattr(built.summary, name))
+    assert np.array_equal(updated.regions.counts, built.regions.counts)
+    pd.testing.assert_frame_equal(updated.regions.locations,
+                                  built.regions.locations)
+    for layer, built_layer in zip(updated.spatial.layers,
+                                  built.spatial.layers):
+        assert np.array_equal(layer.store.counts, built_layer.store.counts)
+        assert list(layer.names) == list(built_layer.names)
+        for name in built_layer.derived:
+            assert np.array_equal(layer.derived[name],
+                                  built_layer.derived[name])
+    assert updated.world_total_confirmed == built.world_total_confirmed
+    assert updated.most_confirmed_province == built.most_confirmed_province
+
+
+def renamed(frames):
+    """
+    Renames Thailand, the way the source once renamed some countries.
+    """
+    frames = {metric: df.copy() for metric, df in frames.items()}
+    for df in frames.values():
+        df['Country/Region'] = df['Country/Region'].replace('Thailand',
+                                                            'Thailand*')
+    return frames
+
+
+def corrected(frames):
+    """
+    Corrects an earlier count and moves a location's coordinates.
+    """
+    frames = {metric: df.copy() for metric, df in frames.items()}
+    frames['Deaths'].iloc[2, 6] += 7
+    for df in frames.values():
+        df.loc[5, 'Lat'] = 42.0
+    return frames
+
+
+@pytest.mark.parametrize('change', [
+    lambda frames: frames,
+    corrected,
+    renamed,
+    lambda frames: {metric: df.drop(index=1)
+                    for metric, df in frames.items()},
+    lambda frames: {metric: df.iloc[:, :-2] for metric, df in frames.items()},
+], ids=['new dates', 'corrected', 'renamed', 'removed', 'removed dates'])
+def test_update_matches_full_build(change):
+    """
+    Updating a Dataset with newer files gives the same data as building it
+    from those files, whether dates were added, counts corrected, or
+    locations renamed or removed.
+    """
+    frames = wide_frames()
+    old = {metric: df.iloc[:, :-1] for metric, df in frames.items()}
+    previous = data.Dataset(data.build_store(old), version='old')
+    new = change(frames)
+    assert_same_dataset(previous.update(new, 'new'),
+                        data.Dataset(data.build_store(new), version='new'))
+
+
+def test_ingest_daily_in_chunks(tmp_path):
+    """
+    Merging daily reports into the store a few files at a time, or into a
+    store read from earlier files, gives the same store as reading every
+    file at once.
+    """
+    import benchmark
+    sources = benchmark.make_synthetic(str(tmp_path), 40, 12)
+    files = benchmark.make_daily(str(tmp_path / 'daily'), sources)
+    whole = data.ingest_daily(files, processes=1)
+    for store in (data.ingest_daily(files, processes=1, chunk=5),
+                  data.ingest_daily(files[-2:], data.ingest_daily(
+                      files[:-2], processes=1), processes=1)):
+        assert store.dates == whole.dates
+        assert store.location_index.equals(whole.location_index)
+        assert np.array_equal(store.counts, whole.counts)
+
+
+def test_refresh_keeps_daily_data(tmp_path, monkeypatch):
+    """
+    Refreshing data read from daily reports reads the folder again rather
+    than loading the time series files, including after attaching to its
+    snapshot, and picks up new files.
+    """
+    import benchmark
+    monkeypatch.setattr(data, '_current', None)
+    sources = benchmark.make_synthetic(str(tmp_path), 40, 12)
+    files = benchmark.make_daily(str(tmp_path / 'daily'), sources)
+    snapshot_dir = str(tmp_path / 'snapshots')
+    os.rename(files[-1], str(tmp_path / 'held.csv'))
+    loaded = data.load_daily(str(tmp_path / 'daily'), snapshot_dir, 1)
+    assert data.refresh([], snapshot_dir) is loaded
+
+    monkeypatch.setattr(data, '_current', None)
+    attached = data.attach(snapshot_dir)
+    assert attached.folder == loaded.folder
+    os.rename(str(tmp_path / 'held.csv'), files[-1])
+    refreshed = data.refresh([], snapshot_dir)
+    assert refreshed.folder == loaded.folder
+    assert len(refreshed.dates) == len(loaded.dates) + 1
+
+
+def test_unknown_module_attributes_load_nothing(monkeypatch):
+    """
+    Looking up a name the module never defined raises AttributeError
+    without attaching to or loading any data.
+    """
+    monkeypatch.setattr(data, '_current', None)
+    monkeypatch.setattr(data, 'attach', lambda *args: pytest.fail())
+    assert not hasattr(data, 'foo_bar')
+    assert data._current is None
+
+
+def test_prune_snapshots(tmp_path):
+    """
+    Pruning after publishing keeps the new snapshot, the newest snapshot of
+    the other kind, and any snapshot saved too recently to have been
+    published, and removes the rest.
+    """
+    def snapshot(name, files, age):
+        path = tmp_path / name
+        path.mkdir()
+        (path / 'snapshot.json').write_text(json.dumps(dict(
+            format=data.SNAPSHOT_FORMAT, version=name, files=files)))
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return str(path)
+
+    snapshot('daily_old', {'a.csv': [1, 1]}, 400)
+    snapshot('daily_new', {'a.csv': [2, 2]}, 300)
+    snapshot('series_old', None, 200)
+    snapshot('saving', None, 1)
+    path = snapshot('series_new', None, 100)
+    data.publish(path)
+    data.prune_snapshots(path)
+    assert sorted(os.listdir(tmp_path)) == ['current', 'daily_new', 'saving',
+                                            'series_new']
+
+
+@pytest.mark.parametrize('with_rank', [False, True])
+def test_top_positions_matches_stable_sort(with_rank):
+    """
+    The leaders on each date and metric are the highest counts first, with
+    ties going to the location of lower rank, the same as a stable sort.
+    """
+    rng = np.random.default_rng(1)
+    counts = rng.integers(0, 4, (60, 70, 3)).astype(np.int16)
+    rank = rng.permutation(60) if with_rank else np.arange(60)
+    top = data.top_positions(counts, 5, rank if with_rank else None,
+                             chunk=16)
+    for day in range(counts.shape[1]):
+        for metric in range(counts.shape[2]):
+            expected = np.lexsort((rank, -counts[:, day, metric]))[:5]
+            assert list(top[day, metric]) == list(expected)
+    assert data.top_positions(counts[:3], 5).shape == (70, 3, 3)
+
+
+def test_regions_sum_their_leaves():
+    """
+    A state's totals hold its own row and its counties, a country's hold
+    all of its locations, and every region appears once.
+    """
+    dataset = data.Dataset(data.build_store(wide_frames()))
+    store = dataset.store
+    province = store.locations['Province/State'].fillna('')
+    country = store.locations['Country/Region']
+
+    def total(rows, day):
+        return {metric: int(store.counts[rows.to_numpy(), day, k].sum())
+                for k, metric in enumerate(store.metrics)}
+
+    washington = (country == 'US') & ((province == 'Washington') |
+                                      province.str.endswith(', WA'))
+    assert dataset.region('US / Washington', -1) == total(washington, -1)
+    assert dataset.region('US / Washington / King County, WA', 2) == \
+        total(province == 'King County, WA', 2)
+    assert dataset.region('China', 0) == total(country == 'China', 0)
+    assert dataset.region('Total', -1) == total(country == country, -1)
+    assert list(dataset.hierarchy.find('Washington')) == \
+        [dataset.hierarchy.position('US / Washington')]
+    assert dataset.region('Atlantis', 0) == dict.fromkeys(store.metrics, 0)